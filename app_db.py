@@ -2,7 +2,9 @@ import os, json, uuid, datetime as dt
 import re 
 import csv, io
 import math
-from flask import Flask, request, jsonify, send_from_directory, session, Blueprint, Response, abort, current_app
+import itertools
+from types import SimpleNamespace
+from flask import Flask, request, jsonify, send_from_directory, send_file, session, Blueprint, Response, abort, current_app
 from itsdangerous import URLSafeSerializer, BadSignature
 from openai import OpenAI
 from sqlalchemy import text, func
@@ -58,9 +60,10 @@ signer = URLSafeSerializer(app.secret_key, salt="auth")
 # -------------------------------
 from sqlalchemy import (
     create_engine, Column, String, Integer, Boolean, Text,
-    DateTime, ForeignKey, func, or_, and_
+    DateTime, ForeignKey, func, or_, and_, LargeBinary, Index
 )
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy import literal_column, bindparam, type_coerce
+from sqlalchemy.orm import declarative_base, sessionmaker, relationship, Session
 
 # Path to the SQLite file (Render Disk recommended: /var/data/dti.sqlite3)
 DB_FILE = os.getenv("DB_FILE", os.path.join(os.path.dirname(__file__), "local.sqlite3"))
@@ -72,13 +75,54 @@ engine = create_engine(
     DB_URL,
     connect_args={"check_same_thread": False} if DB_URL.startswith("sqlite") else {},
     pool_pre_ping=True,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
 )
 
 print(f"[DB] Using DB_FILE={DB_FILE} -> DB_URL={DB_URL}", flush=True)
 
+# --- SQLite storage profile, applied to every pooled connection ---
+# Per-connection pragmas (busy_timeout, cache_size, mmap_size, temp_store, ...) are
+# lost when a connection is reopened, so they are set in a connect listener.
+SQLITE_PRAGMAS = {
+    "busy_timeout":       int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),     # wait for the writer instead of 'database is locked'
+    "synchronous":        os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),            # NORMAL is durable enough under WAL
+    "cache_size":         -int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384")),     # negative = KiB
+    "mmap_size":          int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "temp_store":         os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+    "wal_autocheckpoint": int(os.getenv("SQLITE_WAL_AUTOCHECKPOINT", "1000")),   # pages
+    "journal_size_limit": int(os.getenv("SQLITE_JOURNAL_SIZE_LIMIT", str(64 * 1024 * 1024))),  # WAL is truncated back to this
+}
+
+from sqlalchemy import event
+
+@event.listens_for(engine, "connect")
+def _apply_storage_profile(dbapi_conn, conn_record):
+    cur = dbapi_conn.cursor()
+    # only takes effect on a new, empty DB file (an existing one needs a full VACUUM to switch)
+    cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cur.execute("PRAGMA journal_mode=WAL")              # better concurrent reads (persistent)
+    for name, value in SQLITE_PRAGMAS.items():
+        cur.execute(f"PRAGMA {name}={value}")
+    cur.close()
+
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 Base = declarative_base()
 
+def after_commit(s, fn, *args, **kw):
+    """Run fn once s commits (dropped on rollback): cache invalidation must not race the write."""
+    s.info.setdefault("after_commit", []).append((fn, args, kw))
+
+@event.listens_for(Session, "after_commit")
+def _run_after_commit(s):
+    for fn, args, kw in s.info.pop("after_commit", []):
+        fn(*args, **kw)
+
+@event.listens_for(Session, "after_rollback")
+def _drop_after_commit(s):
+    s.info.pop("after_commit", None)
+
 
 # -------------------------------
 # Models
@@ -102,6 +146,7 @@ class WebSession(Base):
     user_id = Column(String, ForeignKey("users.id"), nullable=False)
     created_at = Column(DateTime, default=func.now(), nullable=False)
     expires_at = Column(DateTime, nullable=False)
+    __table_args__ = (Index("ix_sessions_expires", "expires_at"), Index("ix_sessions_user", "user_id"))
 
 class Transcript(Base):
     __tablename__ = "transcripts"
@@ -115,8 +160,15 @@ class Transcript(Base):
     token_output = Column(Integer, default=0, nullable=False)
     token_total = Column(Integer, default=0, nullable=False)
     month_key = Column(String, nullable=False)
+    summary = Column(Text)                      # rolling summary of turns older than the history window
+    summary_upto = Column(DateTime)             # created_at of the last message folded into summary
+    archived_at = Column(DateTime)              # its messages were moved to transcript_archives
+    message_count = Column(Integer, default=0, nullable=False)   # kept by save_msg; survives archiving
+    last_message_at = Column(DateTime)
 
     messages = relationship("TranscriptMessage", backref="transcript", cascade="all, delete-orphan")
+    __table_args__ = (Index("ix_transcripts_owner_month", "user_id", "character", "month_key", "started_at"),
+                      Index("ix_transcripts_started", "started_at", "id"))
 
 class TranscriptMessage(Base):
     __tablename__ = "transcript_messages"
@@ -128,6 +180,9 @@ class TranscriptMessage(Base):
     usage_input = Column(Integer, default=0)
     usage_output = Column(Integer, default=0)
     usage_total = Column(Integer, default=0)
+    usage_cached = Column(Integer, default=0)   # prompt tokens served from the provider's prompt cache
+    __table_args__ = (Index("ix_transcript_messages_tr_role_created", "transcript_id", "role", "created_at"),
+                      Index("ix_transcript_messages_created", "created_at", "id"))   # usage rollup walks this
 
 class UserProfile(Base):
     __tablename__ = "user_profiles"
@@ -152,31 +207,600 @@ class Memory(Base):
     importance = Column(Integer, default=2)     # 1..5
     follow_up_after = Column(DateTime)          # optional reminder moment
     created_at = Column(DateTime, default=func.now(), nullable=False)
+    __table_args__ = (Index("ix_memories_owner_created", "user_id", "character", "created_at"),)
 
-Base.metadata.create_all(bind=engine)
+class MemoryVector(Base):
+    """Embedding of one memory (float32 bytes) for semantic recall; `model` names the embedder."""
+    __tablename__ = "memory_vectors"
+    memory_id = Column(String, ForeignKey("memories.id"), primary_key=True)
+    user_id = Column(String, nullable=False)
+    character = Column(String, nullable=False)
+    model = Column(String, nullable=False)
+    vec = Column(LargeBinary, nullable=False)
+    __table_args__ = (Index("ix_memory_vectors_owner", "user_id", "character", "model"),)
+
+class TranscriptArchive(Base):
+    """One user's messages for one cold month: zlib-compressed JSONL (see archive_cold_months)."""
+    __tablename__ = "transcript_archives"
+    user_id = Column(String, primary_key=True)
+    month_key = Column(String, primary_key=True)
+    message_count = Column(Integer, default=0, nullable=False)
+    raw_bytes = Column(Integer, default=0, nullable=False)     # uncompressed size
+    blob = Column(LargeBinary, nullable=False)
+    archived_at = Column(DateTime, default=func.now(), nullable=False)
+
+class UsageDaily(Base):
+    """Per-day usage rollup of transcript_messages, maintained by rollup_usage_daily()."""
+    __tablename__ = "usage_daily"
+    day = Column(String, primary_key=True)          # YYYY-MM-DD (UTC)
+    user_id = Column(String, primary_key=True)
+    character = Column(String, primary_key=True)
+    token_input = Column(Integer, default=0, nullable=False)
+    token_output = Column(Integer, default=0, nullable=False)
+    token_total = Column(Integer, default=0, nullable=False)
+    message_count = Column(Integer, default=0, nullable=False)   # user + assistant turns
+    __table_args__ = {"sqlite_with_rowid": False}   # clustered on (day, ...): date ranges read contiguous pages
+
+class RollupWatermark(Base):
+    """How far (transcript_messages (created_at, id), as stored) a rollup has consumed."""
+    __tablename__ = "rollup_watermarks"
+    name = Column(String, primary_key=True)
+    last_created_at = Column(String, default="", nullable=False)
+    last_id = Column(String, default="", nullable=False)
+    updated_at = Column(DateTime)
+
+class UsageLedger(Base):
+    """Running token totals per user+month+character, kept in step with transcripts by bump_totals()."""
+    __tablename__ = "usage_ledger"
+    user_id = Column(String, primary_key=True)
+    month_key = Column(String, primary_key=True)
+    character = Column(String, primary_key=True)
+    token_input = Column(Integer, default=0, nullable=False)
+    token_output = Column(Integer, default=0, nullable=False)
+    token_total = Column(Integer, default=0, nullable=False)
 
-with engine.begin() as conn:
-    conn.exec_driver_sql("PRAGMA journal_mode=WAL;")      # better concurrent reads
-    conn.exec_driver_sql("PRAGMA synchronous=NORMAL;")    # durability/speed balance
 
 
-# --- Bootstrap SQLite migrations for existing DBs ---
+# --- Versioned schema migrations ---
+# create_all() only creates missing tables; everything that changes an existing
+# table goes here as a numbered step. schema_version records the steps applied;
+# each step runs once, in order, in its own BEGIN IMMEDIATE transaction, and the
+# whole run holds a host-wide file lock, so workers booting together take turns.
+# Steps are idempotent so DBs that predate versioning (columns already added by
+# hand) just get stamped.
 from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from contextlib import contextmanager
+import fcntl, time
+
+def try_host_lock(name, blocking=False):
+    """flock on <DB dir>/<name>.lock. Returns the open file, which holds the lock until
+    closed (or the process exits), or None if another process holds it."""
+    f = open(os.path.join(os.path.dirname(DB_FILE), f"{name}.lock"), "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+@contextmanager
+def host_lock(name, blocking=True):
+    """Yields True while <name>.lock is held, False if busy and not blocking."""
+    f = try_host_lock(name, blocking)
+    try:
+        yield f is not None
+    finally:
+        if f is not None:
+            f.close()
 
-def add_column_if_missing(table: str, colname: str, ddl_fragment: str):
+def owner_loop(name, interval, fn, label):
+    """
+    Run fn every interval seconds, but only in the one process on this host that holds
+    <name>.lock (gunicorn workers all start the thread). The others keep trying, so
+    another worker takes over when the owner exits.
+    """
+    held = None
+    while True:
+        time.sleep(interval)
+        held = held or try_host_lock(name)
+        if held is None:
+            continue
+        try:
+            fn()
+        except Exception as e:
+            print(f"[{label}] failed: {e}", flush=True)
+
+@contextmanager
+def write_locked():
+    """A connection inside BEGIN IMMEDIATE: the write lock is taken before the first read,
+    so a check-then-change (is step N applied? apply it) cannot interleave with another writer."""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.exec_driver_sql("ROLLBACK")
+            raise
+        conn.exec_driver_sql("COMMIT")
+
+def add_column_if_missing(conn, table: str, colname: str, ddl_fragment: str):
     """
     Ensure a column exists on an existing SQLite table.
     ddl_fragment must be a full 'COLUMN_DEF' like:
       'abuse_count INTEGER NOT NULL DEFAULT 0'
     """
+    cols = [row[1] for row in conn.execute(text(f"PRAGMA table_info({table});")).fetchall()]
+    if colname not in cols:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {ddl_fragment};"))
+
+def _m1_moderation(conn):
+    add_column_if_missing(conn, "users", "abuse_count", "abuse_count INTEGER NOT NULL DEFAULT 0")
+    add_column_if_missing(conn, "users", "is_banned",   "is_banned INTEGER NOT NULL DEFAULT 0")  # INTEGER plays nicest in SQLite
+
+def _m2_usage_cached(conn):
+    add_column_if_missing(conn, "transcript_messages", "usage_cached", "usage_cached INTEGER DEFAULT 0")
+
+def _m3_summary(conn):
+    add_column_if_missing(conn, "transcripts", "summary", "summary TEXT")
+    add_column_if_missing(conn, "transcripts", "summary_upto", "summary_upto DATETIME")
+
+def _m4_hot_indexes(conn):
+    # history window, transcript lookup per month, memory recall (see explain_hot_queries)
+    conn.execute(text("""CREATE INDEX IF NOT EXISTS ix_transcripts_owner_month
+                         ON transcripts (user_id, character, month_key, started_at)"""))
+    conn.execute(text("""CREATE INDEX IF NOT EXISTS ix_transcript_messages_tr_role_created
+                         ON transcript_messages (transcript_id, role, created_at)"""))
+    conn.execute(text("""CREATE INDEX IF NOT EXISTS ix_memories_owner_created
+                         ON memories (user_id, character, created_at)"""))
+    conn.execute(text("ANALYZE"))   # give the planner row counts for the new indexes
+
+def _m5_archived_at(conn):
+    add_column_if_missing(conn, "transcripts", "archived_at", "archived_at DATETIME")
+
+def _m6_session_indexes(conn):
+    # the expiry sweeper walks sessions by expires_at and checks guests by user_id
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_sessions_expires ON sessions (expires_at)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_sessions_user ON sessions (user_id)"))
+
+def _m7_transcript_counters(conn):
+    add_column_if_missing(conn, "transcripts", "message_count", "message_count INTEGER NOT NULL DEFAULT 0")
+    add_column_if_missing(conn, "transcripts", "last_message_at", "last_message_at DATETIME")
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transcripts_started ON transcripts (started_at, id)"))
+    # backfill from live rows (one grouped pass), then from the archive blobs
+    conn.execute(text("""
+        UPDATE transcripts SET message_count = agg.n, last_message_at = agg.last
+        FROM (SELECT transcript_id, COUNT(*) AS n, MAX(created_at) AS last
+              FROM transcript_messages GROUP BY transcript_id) AS agg
+        WHERE transcripts.id = agg.transcript_id"""))
+    if conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'transcript_archives'")).first():
+        import zlib
+        for (blob,) in conn.execute(text("SELECT blob FROM transcript_archives")).all():
+            per_tr = {}
+            for line in zlib.decompress(blob).decode("utf-8").splitlines():
+                if line:
+                    d = json.loads(line)
+                    n, last = per_tr.get(d["transcript_id"], (0, ""))
+                    per_tr[d["transcript_id"]] = (n + 1, max(last, d.get("created_at") or ""))
+            for tid, (n, last) in per_tr.items():
+                conn.execute(text("""UPDATE transcripts SET message_count = message_count + :n,
+                                         last_message_at = MAX(COALESCE(last_message_at, ''), :last)
+                                     WHERE id = :tid"""),
+                             {"tid": tid, "n": n, "last": dt.datetime.fromisoformat(last) if last else None})
+
+def _m8_rollup_keyset(conn):
+    # rowids are reused once the newest rows are deleted, so the rollup walks (created_at, id) instead
+    conn.execute(text("""CREATE INDEX IF NOT EXISTS ix_transcript_messages_created
+                         ON transcript_messages (created_at, id)"""))
+    # a rowid position has no (created_at, id) equivalent: start the table over (the next
+    # rollup finds no watermark and rebuilds usage_daily)
+    conn.execute(text("DROP TABLE rollup_watermarks"))
+    RollupWatermark.__table__.create(bind=conn)
+
+MIGRATIONS = [
+    (1, "moderation columns on users", _m1_moderation),
+    (2, "transcript_messages.usage_cached", _m2_usage_cached),
+    (3, "rolling summary on transcripts", _m3_summary),
+    (4, "composite indexes for hot queries + ANALYZE", _m4_hot_indexes),
+    (5, "transcripts.archived_at", _m5_archived_at),
+    (6, "indexes for the session/guest sweeper", _m6_session_indexes),
+    (7, "transcripts.message_count/last_message_at + browse index", _m7_transcript_counters),
+    (8, "usage rollup watermark on (created_at, id)", _m8_rollup_keyset),
+]
+
+def schema_version(conn):
+    return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar()
+
+def migrate():
+    """Create missing tables, then apply pending MIGRATIONS in order. Returns the versions applied."""
+    with write_locked() as conn:
+        Base.metadata.create_all(bind=conn)
+        conn.execute(text("""CREATE TABLE IF NOT EXISTS schema_version (
+                                 version INTEGER PRIMARY KEY,
+                                 name TEXT NOT NULL,
+                                 applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP)"""))
+    applied = []
+    for version, name, step in MIGRATIONS:
+        with write_locked() as conn:
+            if conn.execute(text("SELECT 1 FROM schema_version WHERE version = :v"), {"v": version}).first():
+                continue
+            step(conn)
+            conn.execute(text("INSERT INTO schema_version (version, name) VALUES (:v, :n)"),
+                         {"v": version, "n": name})
+        applied.append(version)
+        print(f"[MIGRATE] {version}: {name}", flush=True)
+    return applied
+
+
+@app.cli.command("migrate")
+def migrate_cmd():
+    """Apply pending schema migrations, ledger backfill and FTS setup: flask --app app_db migrate"""
+    applied = init_db()
+    with engine.connect() as conn:
+        print(f"[MIGRATE] applied {applied or 'nothing'}; schema version {schema_version(conn)}")
+
+
+# Hot queries, built by the same functions (or from the same SQL) the request paths use,
+# so a change to any of them is what gets planned. A plan that falls back to a full scan
+# of a base table or one of its indexes (SCAN <table>) is a regression. Each entry takes a
+# Session and returns an ORM query or (sql, params); the builders are defined further down.
+_SAMPLE = {"uid": "u", "ch": "c", "since": dt.datetime(2025, 1, 1), "n": 6, "q": '"boat"'}
+_HOT_QUERIES = {
+    "admin transcript browser page":
+        lambda s: browse_transcripts_query(s, after=("2025-01-01", "t")).limit(51),
+    "transcript for user+character+month":
+        lambda s: transcript_for_month_query(s, "u", "c", "2025-01").limit(1),
+    "history tail window":
+        lambda s: history_window_query(s, "t", dt.datetime(2025, 1, 1)).limit(23),
+    "memories recall (FTS)": lambda s: (_MEMORIES_FTS_SQL, _SAMPLE),
+    "memories recall (LIKE fallback)":
+        lambda s: _like_memories_query(s, "u", "c", ["boat"], _SAMPLE["since"]).limit(6),
+    "transcript recall (FTS)": lambda s: (_MESSAGES_FTS_SQL, _SAMPLE),
+    "transcript recall (LIKE fallback)":
+        lambda s: _like_messages_query(s, "u", "c", ["boat"], _SAMPLE["since"]).limit(3),
+    "recall neighbour turn":
+        lambda s: (_NEIGHBOUR_SEEK.format(i=0, step=-1, role="user", cmp="<", order="DESC"),
+                   {"hit0": "m", "tid0": "t", "at0": "2025-01-01 00:00:00.000000", "rid0": 1}),
+}
+
+def _explain(conn, built):
+    if isinstance(built, tuple):
+        sql, params = built
+        params = {k: (v.strftime("%Y-%m-%d %H:%M:%S.%f") if isinstance(v, dt.datetime) else v)
+                  for k, v in params.items()}
+        return conn.execute(text("EXPLAIN QUERY PLAN " + sql), params).fetchall()
+    compiled = built.statement.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})
+    return conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled),
+                                tuple(compiled.params[k] for k in compiled.positiontup)).fetchall()
+
+def explain_hot_queries(conn, names=None):
+    """{name: (plan lines, full-scan tables)} from EXPLAIN QUERY PLAN. FTS entries are skipped without FTS."""
+    out = {}
+    s = Session(bind=conn)
+    try:
+        for name, build in _HOT_QUERIES.items():
+            if (names and name not in names) or ("(FTS)" in name and not FTS_ENABLED):
+                continue
+            plan = [row[3] for row in _explain(conn, build(s))]
+            # "SCAN x USING INDEX" still walks the whole index; FTS lookups show up as
+            # "SCAN f VIRTUAL TABLE INDEX ..." and materialized CTEs as "SCAN r": both fine
+            ctes = {p.split()[1] for p in plan if p.startswith("MATERIALIZE ")}
+            scans = [p.split()[1] for p in plan if p.startswith("SCAN ") and "VIRTUAL TABLE" not in p
+                     and p.split()[1] not in ctes]
+            out[name] = (plan, scans)
+    finally:
+        s.close()
+    return out
+
+
+@app.cli.command("check-query-plans")
+def check_query_plans_cmd():
+    """Fail if a hot query plans a full table scan: flask --app app_db check-query-plans"""
+    with engine.connect() as conn:
+        report = explain_hot_queries(conn)
+    bad = 0
+    for name, (plan, scans) in report.items():
+        print(f"{'FULL SCAN' if scans else 'ok':9}  {name}: {' | '.join(plan)}")
+        bad += bool(scans)
+    if bad:
+        raise SystemExit(1)
+
+
+def rebuild_usage_ledger(conn):
+    """Recompute usage_ledger from transcripts (one transaction; safe to re-run)."""
+    conn.execute(text("DELETE FROM usage_ledger"))
+    res = conn.execute(text("""
+        INSERT INTO usage_ledger (user_id, month_key, character, token_input, token_output, token_total)
+        SELECT user_id, month_key, character,
+               COALESCE(SUM(token_input), 0), COALESCE(SUM(token_output), 0), COALESCE(SUM(token_total), 0)
+        FROM transcripts
+        GROUP BY user_id, month_key, character
+    """))
+    return res.rowcount
+
+def backfill_usage_ledger():
+    """Backfill once for DBs that predate the ledger."""
+    with write_locked() as conn:
+        if conn.execute(text("SELECT 1 FROM usage_ledger LIMIT 1")).first() is None \
+                and conn.execute(text("SELECT 1 FROM transcripts LIMIT 1")).first() is not None:
+            rebuild_usage_ledger(conn)
+
+
+@app.cli.command("rebuild-usage-ledger")
+def rebuild_usage_ledger_cmd():
+    """Backfill usage_ledger from transcripts: flask --app app_db rebuild-usage-ledger"""
+    with engine.begin() as conn:
+        n = rebuild_usage_ledger(conn)
+    print(f"[LEDGER] rebuilt {n} row(s)")
+
+
+# --- Full-text indexes for recall (SQLite FTS5, external-content tables kept in sync by triggers) ---
+# Rows are keyed by the base tables' implicit rowid; run `flask --app app_db rebuild-fts` after a full VACUUM.
+_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5(
+           title, content, content='memories', content_rowid='rowid', tokenize='porter unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS memories_fts_ai AFTER INSERT ON memories BEGIN
+           INSERT INTO memories_fts(rowid, title, content) VALUES (new.rowid, new.title, new.content);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS memories_fts_ad AFTER DELETE ON memories BEGIN
+           INSERT INTO memories_fts(memories_fts, rowid, title, content) VALUES ('delete', old.rowid, old.title, old.content);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS memories_fts_au AFTER UPDATE OF title, content ON memories BEGIN
+           INSERT INTO memories_fts(memories_fts, rowid, title, content) VALUES ('delete', old.rowid, old.title, old.content);
+           INSERT INTO memories_fts(rowid, title, content) VALUES (new.rowid, new.title, new.content);
+       END""",
+    # Only conversation turns are searchable; system-ui rows stay out of the index
+    """CREATE VIRTUAL TABLE IF NOT EXISTS transcript_messages_fts USING fts5(
+           content, content='transcript_messages', content_rowid='rowid', tokenize='porter unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS transcript_messages_fts_ai AFTER INSERT ON transcript_messages
+       WHEN new.role IN ('user', 'assistant') BEGIN
+           INSERT INTO transcript_messages_fts(rowid, content) VALUES (new.rowid, new.content);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS transcript_messages_fts_ad AFTER DELETE ON transcript_messages
+       WHEN old.role IN ('user', 'assistant') BEGIN
+           INSERT INTO transcript_messages_fts(transcript_messages_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+       END""",
+]
+
+def rebuild_fts(conn):
+    """Re-index both FTS tables from their base tables."""
+    conn.execute(text("INSERT INTO memories_fts(memories_fts) VALUES ('rebuild')"))
+    conn.execute(text("INSERT INTO transcript_messages_fts(transcript_messages_fts) VALUES ('delete-all')"))
+    conn.execute(text("""
+        INSERT INTO transcript_messages_fts(rowid, content)
+        SELECT rowid, content FROM transcript_messages WHERE role IN ('user', 'assistant')
+    """))
+
+FTS_WANTED = os.getenv("FTS_ENABLED", "true").lower() in ("1","true","yes")
+FTS_ENABLED = FTS_WANTED   # whether recall uses FTS in this process
+
+FTS_SETUP_ATTEMPTS = int(os.getenv("FTS_SETUP_ATTEMPTS", "5"))
+
+def setup_fts():
+    """Create the FTS tables/triggers (backfilled on first run). Sets FTS_ENABLED."""
+    global FTS_ENABLED
+    if not FTS_WANTED:
+        return
+    for attempt in range(1, FTS_SETUP_ATTEMPTS + 1):
+        try:
+            with write_locked() as conn:
+                existed = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'transcript_messages_fts'")).first() is not None
+                for ddl in _FTS_DDL:
+                    conn.execute(text(ddl))
+                if not existed:
+                    rebuild_fts(conn)   # backfill on first run
+            FTS_ENABLED = True
+            print(f"[FTS] enabled{'' if existed else ' (index built)'}", flush=True)
+            return
+        except OperationalError as e:
+            if "no such module: fts5" in str(e):
+                # SQLite built without FTS5: the only error that turns FTS off for good
+                print("[FTS] disabled: SQLite has no FTS5; recall uses LIKE scans", flush=True)
+                FTS_ENABLED = False
+                return
+            if "locked" not in str(e) or attempt == FTS_SETUP_ATTEMPTS:
+                raise
+            print(f"[FTS] setup attempt {attempt} failed ({e}); retrying", flush=True)
+            time.sleep(attempt)
+
+def check_fts():
+    """For workers that skip setup: use FTS only if `flask migrate` created the tables."""
+    global FTS_ENABLED
+    if FTS_ENABLED:
+        with engine.connect() as conn:
+            FTS_ENABLED = conn.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE name = 'transcript_messages_fts'")).first() is not None
+        if not FTS_ENABLED:
+            print("[FTS] tables missing (run `flask --app app_db migrate`); recall uses LIKE scans", flush=True)
+
+
+# Schema setup is a deploy step: `flask --app app_db migrate` (gunicorn.conf.py runs it once
+# before forking workers and sets AUTO_MIGRATE=0 for them). AUTO_MIGRATE=1, the default,
+# keeps `flask run` and single-process servers self-initialising.
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "true").lower() in ("1","true","yes")
+
+def init_db():
+    """Tables, migrations, one-off backfills and FTS, under a host-wide lock. Returns the migrations applied."""
+    with host_lock("migrate"):
+        applied = migrate()
+        backfill_usage_ledger()
+        setup_fts()
+    return applied
+
+if AUTO_MIGRATE:
+    init_db()
+else:
+    check_fts()
+
+
+@app.cli.command("rebuild-fts")
+def rebuild_fts_cmd():
+    """Re-index recall FTS tables: flask --app app_db rebuild-fts"""
     with engine.begin() as conn:
-        cols = [row[1] for row in conn.execute(text(f"PRAGMA table_info({table});")).fetchall()]
-        if colname not in cols:
-            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {ddl_fragment};"))
+        rebuild_fts(conn)
+    print("[FTS] rebuilt memories_fts, transcript_messages_fts")
+
+
+# --- Scheduled SQLite maintenance: checkpoint + truncate the WAL, refresh planner stats, reclaim free pages ---
+import threading, time, click
+
+DB_MAINTENANCE_INTERVAL_SECS = int(os.getenv("DB_MAINTENANCE_INTERVAL_SECS", "3600"))   # 0 = CLI only
+DB_INCREMENTAL_VACUUM_PAGES  = int(os.getenv("DB_INCREMENTAL_VACUUM_PAGES", "2000"))
+
+def _wal_bytes():
+    try:
+        return os.path.getsize(DB_FILE + "-wal")
+    except OSError:
+        return 0
+
+def db_maintenance(vacuum_pages=None):
+    """One maintenance pass; returns what it did. Safe to run while serving."""
+    pages = DB_INCREMENTAL_VACUUM_PAGES if vacuum_pages is None else vacuum_pages
+    out = {"wal_bytes_before": _wal_bytes()}
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        # busy=1 means readers kept part of the WAL alive; the next pass catches up
+        busy, log_pages, done = conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        out["checkpoint"] = {"busy": busy, "log_pages": log_pages, "checkpointed": done}
+        conn.exec_driver_sql("PRAGMA optimize")
+        out["freelist_before"] = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+        if pages and conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2:   # 2 = INCREMENTAL
+            conn.exec_driver_sql(f"PRAGMA incremental_vacuum({int(pages)})")
+        out["freelist_after"] = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+    out["wal_bytes_after"] = _wal_bytes()
+    return out
+
+def _maintenance_pass():
+    if SWEEP_ENABLED:
+        sweep_expired()
+    if ARCHIVE_AUTO:
+        archive_cold_months()   # before the pass, so freed pages are reclaimed right away
+    db_maintenance()
+
+# One owner per host: N workers would run N truncating checkpoints, sweeps and archive passes
+if DB_MAINTENANCE_INTERVAL_SECS > 0:
+    threading.Thread(target=owner_loop, args=("maintenance", DB_MAINTENANCE_INTERVAL_SECS, _maintenance_pass, "DB"),
+                     name="db-maintenance", daemon=True).start()
+
+
+@app.cli.command("db-maintenance")
+@click.option("--vacuum", is_flag=True,
+              help="Full VACUUM (switches the file to incremental auto_vacuum; rebuilds FTS since rowids can change).")
+def db_maintenance_cmd(vacuum):
+    """Checkpoint/optimize/reclaim now: flask --app app_db db-maintenance [--vacuum]"""
+    if vacuum:
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.exec_driver_sql("VACUUM")
+        if FTS_ENABLED:
+            with engine.begin() as conn:
+                rebuild_fts(conn)
+    print(f"[DB] maintenance: {db_maintenance()}")
+
+
+# --- Point-in-time snapshots (SQLite online backup API) for offline analytics ---
+# The copy is made in steps of SNAPSHOT_PAGES_PER_STEP pages with a pause in between,
+# so chat writes keep flowing. A write from another connection restarts the copy; after
+# SNAPSHOT_MAX_RESTARTS of those it is done in one step instead (one read transaction,
+# which writers in WAL mode don't wait on).
+# Admin read endpoints take ?source=snapshot to read the latest one instead of the live DB.
+import sqlite3, glob
+
+SNAPSHOT_DIR            = os.getenv("SNAPSHOT_DIR", os.path.join(os.path.dirname(DB_FILE), "snapshots"))
+SNAPSHOT_PAGES_PER_STEP = int(os.getenv("SNAPSHOT_PAGES_PER_STEP", "1024"))
+SNAPSHOT_SLEEP_MS       = float(os.getenv("SNAPSHOT_SLEEP_MS", "20"))
+SNAPSHOT_KEEP           = int(os.getenv("SNAPSHOT_KEEP", "3"))
+SNAPSHOT_INTERVAL_SECS  = int(os.getenv("SNAPSHOT_INTERVAL_SECS", "0"))   # 0 = on demand only
+SNAPSHOT_MAX_RESTARTS   = int(os.getenv("SNAPSHOT_MAX_RESTARTS", "5"))
+
+_snapshot_lock = threading.Lock()
+_snapshot_engines = {}   # path -> read-only engine
+
+def list_snapshots():
+    """Finished snapshot files, newest first."""
+    return sorted(glob.glob(os.path.join(SNAPSHOT_DIR, "snapshot-*.sqlite3")), reverse=True)
+
+class _BackupRestarted(Exception):
+    pass
+
+def _paced_backup(src, dst):
+    """Stepped backup; returns the number of restarts (-1 if it fell back to one step)."""
+    seen = {"remaining": None, "restarts": 0}
+    def progress(status, remaining, total):
+        if seen["remaining"] is not None and remaining > seen["remaining"]:
+            seen["restarts"] += 1   # another connection wrote: SQLite started over
+            if seen["restarts"] > SNAPSHOT_MAX_RESTARTS:
+                raise _BackupRestarted()
+        seen["remaining"] = remaining
+        time.sleep(SNAPSHOT_SLEEP_MS / 1000.0)   # backup()'s own sleep= only applies when the source is busy
+    try:
+        src.backup(dst, pages=SNAPSHOT_PAGES_PER_STEP, progress=progress)
+        return seen["restarts"]
+    except _BackupRestarted:
+        src.backup(dst, pages=-1)
+        return -1
+
+def take_snapshot():
+    """
+    Copy the live DB to SNAPSHOT_DIR; returns {path, bytes, seconds, restarts}, or None
+    if another process on this host is taking one right now.
+    """
+    with _snapshot_lock, host_lock("snapshot", blocking=False) as held:
+        if not held:
+            return None
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        t = time.perf_counter()
+        path = os.path.join(SNAPSHOT_DIR, f"snapshot-{dt.datetime.utcnow():%Y%m%dT%H%M%S%f}Z.sqlite3")
+        part = os.path.join(SNAPSHOT_DIR, f".{os.getpid()}-{uuid.uuid4().hex}.part")
+        src = sqlite3.connect(DB_FILE)
+        dst = sqlite3.connect(part)
+        try:
+            src.execute(f"PRAGMA busy_timeout={SQLITE_PRAGMAS['busy_timeout']}")
+            restarts = _paced_backup(src, dst)
+            dst.execute("PRAGMA journal_mode=DELETE")   # a single self-contained file
+        except BaseException:
+            dst.close()
+            os.remove(part)
+            raise
+        finally:
+            dst.close()
+            src.close()
+        os.replace(part, path)   # readers only ever see finished files
+        for old in list_snapshots()[SNAPSHOT_KEEP:]:
+            os.remove(old)
+        _prune_snapshot_engines()
+        return {"path": path, "bytes": os.path.getsize(path), "seconds": round(time.perf_counter() - t, 3),
+                "restarts": restarts}
+
+def _prune_snapshot_engines():
+    # any worker may have pruned the files; an open engine would keep the disk space
+    for p in [p for p in _snapshot_engines if not os.path.exists(p)]:
+        _snapshot_engines.pop(p).dispose()
+
+def snapshot_engine():
+    """Read-only engine on the latest snapshot, or None if there is none."""
+    snaps = list_snapshots()
+    if not snaps:
+        return None
+    path = snaps[0]
+    eng = _snapshot_engines.get(path)
+    if eng is None:
+        _prune_snapshot_engines()
+        # immutable: the file never changes, so SQLite skips locking and change detection
+        eng = _snapshot_engines[path] = create_engine(
+            f"sqlite:///file:{path}?mode=ro&immutable=1&uri=true",
+            connect_args={"check_same_thread": False})
+    return eng
 
-# Add the moderation columns if missing
-add_column_if_missing("users", "abuse_count", "abuse_count INTEGER NOT NULL DEFAULT 0")
-add_column_if_missing("users", "is_banned",   "is_banned INTEGER NOT NULL DEFAULT 0")  # INTEGER plays nicest in SQLite
+if SNAPSHOT_INTERVAL_SECS > 0:
+    threading.Thread(target=owner_loop, args=("snapshot-loop", SNAPSHOT_INTERVAL_SECS, take_snapshot, "SNAPSHOT"),
+                     name="db-snapshot", daemon=True).start()
+
+
+@app.cli.command("snapshot")
+def snapshot_cmd():
+    """Write a point-in-time copy of the DB: flask --app app_db snapshot"""
+    print(f"[SNAPSHOT] {take_snapshot() or 'another process is taking one'}")
 
 
 # -------------------------------
@@ -222,11 +846,38 @@ def _readonly_session():
     s = SessionLocal()
     try:
         s.execute(text("PRAGMA query_only=ON"))
-        s.execute(text("PRAGMA busy_timeout=3000"))
     except Exception:
         pass
     return s
 
+class SnapshotMissing(Exception):
+    pass
+
+@admin_bp.errorhandler(SnapshotMissing)
+def _admin_snapshot_missing(e):
+    return jsonify({"ok": False, "error": "No snapshot yet: POST /admin/snapshots or `flask snapshot`"}), 404
+
+def _admin_engine():
+    """The engine admin reads go to: the latest snapshot with ?source=snapshot, else the live DB."""
+    if request.args.get("source") != "snapshot":
+        return engine
+    eng = snapshot_engine()
+    if eng is None:
+        raise SnapshotMissing()
+    return eng
+
+def _admin_session():
+    eng = _admin_engine()
+    return _readonly_session() if eng is engine else Session(bind=eng)
+
+@event.listens_for(engine, "checkin")
+def _reset_query_only(dbapi_conn, conn_record):
+    # query_only sticks to the pooled connection; don't hand it back to a writer
+    try:
+        dbapi_conn.execute("PRAGMA query_only=OFF")
+    except Exception:
+        pass
+
 def _month_bounds(month_str: str):
     # month_str like "2025-08"
     y, m = map(int, month_str.split("-"))
@@ -240,30 +891,83 @@ def admin_ping():
 
 @admin_bp.get("/list/transcripts")
 def admin_list_transcripts():
-    """Quick helper: list recent transcripts so you can grab IDs. Params: ?limit=50&user_id=&character="""
-    limit = min(int(request.args.get("limit", 50)), 500)
+    """
+    Browse transcripts, newest first: ?limit=50 (max 500) &user_id=&character=
+    &month=YYYY-MM &from=YYYY-MM-DD&to=YYYY-MM-DD (inclusive) &after=<next from the previous page>
+    Each row carries message_count, last_message_at and token totals from counter columns
+    on transcripts, and pages are keyset on (started_at, id), so page 200 costs what page 1 does.
+    """
     user_id = request.args.get("user_id")
     character = request.args.get("character")
-
-    s = _readonly_session()
     try:
-        q = s.query(
-            Transcript.id.label("id"),
-            Transcript.user_id.label("user_id"),
-            Transcript.character.label("character"),
-            Transcript.started_at.label("started_at"),
-            Transcript.token_total.label("token_total"),
-            Transcript.month_key.label("month_key"),
-        ).order_by(Transcript.started_at.desc())
-        if user_id:
-            q = q.filter(Transcript.user_id == user_id)
-        if character:
-            q = q.filter(Transcript.character == character)
-        rows = q.limit(limit).all()
-        return jsonify({"rows": [dict(r._mapping) for r in rows]})
+        limit = max(1, min(int(request.args.get("limit", 50)), 500))
+        start, end = _browse_range(request.args.get("month"), request.args.get("from"), request.args.get("to"))
+        after = json.loads(request.args["after"]) if request.args.get("after") else None
+        if after is not None:
+            after = (str(after[0]), str(after[1]))
+    except (ValueError, TypeError, IndexError, KeyError) as e:
+        return jsonify({"ok": False, "error": f"Bad limit, filter or cursor: {e}"}), 400
+
+    s = _admin_session()
+    try:
+        q = browse_transcripts_query(s, user_id, character, request.args.get("month"), start, end, after)
+        rows = q.limit(limit + 1).all()   # one extra row says whether there is a next page
+        more, rows = len(rows) > limit, rows[:limit]
+        out = [{k: (v.isoformat() if isinstance(v, dt.datetime) else v) for k, v in r._mapping.items() if k != "cursor"}
+               for r in rows]
+        nxt = json.dumps([rows[-1].cursor, rows[-1].id]) if more else None
+        return jsonify({"rows": out, "next": nxt})
     finally:
         s.close()
 
+def browse_transcripts_query(s, user_id=None, character=None, month=None, start=None, end=None, after=None):
+    """The transcript browser's keyset query (newest first), without the LIMIT."""
+    # Compare started_at as the stored text: legacy rows lack the microseconds, so a
+    # datetime parameter would not match them exactly and the cursor would skip or repeat.
+    started_raw = type_coerce(Transcript.started_at, String)
+    q = s.query(
+        Transcript.id.label("id"),
+        Transcript.user_id.label("user_id"),
+        Transcript.character.label("character"),
+        Transcript.started_at.label("started_at"),
+        Transcript.ended_at.label("ended_at"),
+        Transcript.month_key.label("month_key"),
+        Transcript.message_count.label("message_count"),
+        Transcript.last_message_at.label("last_message_at"),
+        Transcript.token_input.label("token_input"),
+        Transcript.token_output.label("token_output"),
+        Transcript.token_total.label("token_total"),
+        Transcript.archived_at.label("archived_at"),
+        started_raw.label("cursor"),
+    ).order_by(Transcript.started_at.desc(), Transcript.id.desc())
+    if user_id:
+        q = q.filter(Transcript.user_id == user_id)
+    if character:
+        q = q.filter(Transcript.character == character)
+    if month:
+        q = q.filter(Transcript.month_key == month)
+    if start:
+        q = q.filter(started_raw >= start)
+    if end:
+        q = q.filter(started_raw < end)
+    if after:
+        q = q.filter(tuple_(started_raw, Transcript.id) < tuple_(*after))
+    return q
+
+def _browse_range(month, day_from, day_to):
+    """[start, end) as 'YYYY-MM-DD' strings, which sort right against stored started_at text."""
+    start = end = None
+    if month:
+        first = dt.datetime.strptime(month, "%Y-%m").date()
+        start, end = first, (first + dt.timedelta(days=32)).replace(day=1)
+    if day_from:
+        d = dt.date.fromisoformat(day_from)
+        start = max(start, d) if start else d
+    if day_to:
+        d = dt.date.fromisoformat(day_to) + dt.timedelta(days=1)
+        end = min(end, d) if end else d
+    return (start.isoformat() if start else None), (end.isoformat() if end else None)
+
 @admin_bp.get("/usage/month")
 def admin_usage_month():
     """Totals by user for ?month=YYYY-MM (default current), &user_id=.. &format=csv|json"""
@@ -271,26 +975,21 @@ def admin_usage_month():
     user_id = request.args.get("user_id")
     out_fmt = (request.args.get("format") or "json").lower()
 
-    # compute created_at window as a fallback
-    start, end = _month_bounds(month)
-
-    s = _readonly_session()
+    # Read from usage_ledger (maintained by bump_totals). month_key is always set
+    # from started_at, so no started_at fallback is needed.
+    s = _admin_session()
     try:
         q = (s.query(
-                Transcript.user_id.label("user_id"),
-                func.coalesce(func.sum(Transcript.token_input), 0).label("token_input"),
-                func.coalesce(func.sum(Transcript.token_output), 0).label("token_output"),
-                func.coalesce(func.sum(Transcript.token_total), 0).label("token_total"),
-            )
-            # prefer month_key match, but include rows that have matching created_at if month_key is null/different
-            .filter(
-                (Transcript.month_key == month) |
-                ((Transcript.started_at >= start) & (Transcript.started_at < end))
+                UsageLedger.user_id.label("user_id"),
+                func.coalesce(func.sum(UsageLedger.token_input), 0).label("token_input"),
+                func.coalesce(func.sum(UsageLedger.token_output), 0).label("token_output"),
+                func.coalesce(func.sum(UsageLedger.token_total), 0).label("token_total"),
             )
+            .filter(UsageLedger.month_key == month)
         )
         if user_id:
-            q = q.filter(Transcript.user_id == user_id)
-        rows = q.group_by(Transcript.user_id).all()
+            q = q.filter(UsageLedger.user_id == user_id)
+        rows = q.group_by(UsageLedger.user_id).all()
     finally:
         s.close()
 
@@ -315,6 +1014,88 @@ def admin_usage_month():
                 })
         return jsonify({"month": month, "rows": out_rows})
 
+_DAILY_GROUPS = ("day", "month", "user_id", "character")
+
+@admin_bp.get("/usage/daily")
+def admin_usage_daily():
+    """
+    Usage over any date range from the usage_daily rollup:
+    ?from=YYYY-MM-DD&to=YYYY-MM-DD (inclusive; default last 30 days)
+    &group_by=day,month,user_id,character (any combination; default day)
+    &user_id=..&character=..&format=json|csv
+    Lags the live tables by at most ROLLUP_INTERVAL_SECS (see as_of).
+    """
+    today = dt.datetime.utcnow().date()
+    day_from = request.args.get("from") or (today - dt.timedelta(days=29)).isoformat()
+    day_to = request.args.get("to") or today.isoformat()
+    groups = [g.strip() for g in (request.args.get("group_by") or "day").split(",") if g.strip()]
+    bad = [g for g in groups if g not in _DAILY_GROUPS]
+    if bad:
+        return jsonify({"ok": False, "error": f"group_by: unknown {bad}; use {', '.join(_DAILY_GROUPS)}"}), 400
+    out_fmt = (request.args.get("format") or "json").lower()
+
+    s = _admin_session()
+    try:
+        # Inner: per day (+ user/character if asked), which walks the clustered key in order
+        # without a sort; outer: the requested grouping over those few rows.
+        inner_keys = [UsageDaily.day] + [getattr(UsageDaily, g) for g in ("user_id", "character") if g in groups]
+        inner = (s.query(*inner_keys,
+                         func.sum(UsageDaily.token_input).label("token_input"),
+                         func.sum(UsageDaily.token_output).label("token_output"),
+                         func.sum(UsageDaily.token_total).label("token_total"),
+                         func.sum(UsageDaily.message_count).label("message_count"))
+                   .filter(UsageDaily.day >= day_from, UsageDaily.day <= day_to))   # PK range on day
+        if request.args.get("user_id"):
+            inner = inner.filter(UsageDaily.user_id == request.args["user_id"])
+        if request.args.get("character"):
+            inner = inner.filter(UsageDaily.character == request.args["character"])
+        inner = inner.group_by(*inner_keys).subquery()
+        keys = [(func.substr(inner.c.day, 1, 7) if g == "month" else inner.c[g]).label(g) for g in groups]
+        q = s.query(*keys,
+                    func.sum(inner.c.token_input).label("token_input"),
+                    func.sum(inner.c.token_output).label("token_output"),
+                    func.sum(inner.c.token_total).label("token_total"),
+                    func.sum(inner.c.message_count).label("message_count"))
+        rows = [dict(r._mapping) for r in q.group_by(*keys).order_by(*keys).all()]
+        as_of = s.query(RollupWatermark.updated_at).filter(RollupWatermark.name == _ROLLUP).scalar()
+    finally:
+        s.close()
+
+    cols = groups + ["token_input", "token_output", "token_total", "message_count"]
+    if out_fmt == "csv":
+        buff = io.StringIO()
+        w = csv.writer(buff, lineterminator="\r\n")
+        w.writerow(cols)
+        w.writerows([[r[c] for c in cols] for r in rows])
+        return Response(buff.getvalue(), mimetype="text/csv")
+    return jsonify({"from": day_from, "to": day_to, "group_by": groups,
+                    "as_of": as_of.isoformat() if as_of else None, "rows": rows})
+
+@admin_bp.get("/usage/cache")
+def admin_usage_cache():
+    """Prompt-cache hit ratio per character for ?month=YYYY-MM (default current): cached / prompt tokens on assistant turns."""
+    month = request.args.get("month") or month_key_utc()
+    s = _admin_session()
+    try:
+        rows = (s.query(
+                    Transcript.character.label("character"),
+                    func.count(TranscriptMessage.id).label("turns"),
+                    func.coalesce(func.sum(TranscriptMessage.usage_input), 0).label("prompt_tokens"),
+                    func.coalesce(func.sum(TranscriptMessage.usage_cached), 0).label("cached_tokens"),
+                )
+                .join(Transcript, TranscriptMessage.transcript_id == Transcript.id)
+                .filter(Transcript.month_key == month, TranscriptMessage.role == "assistant")
+                .group_by(Transcript.character)
+                .all())
+    finally:
+        s.close()
+    out = []
+    for r in rows:
+        d = dict(r._mapping)
+        d["hit_ratio"] = round(d["cached_tokens"] / d["prompt_tokens"], 4) if d["prompt_tokens"] else 0.0
+        out.append(d)
+    return jsonify({"month": month, "rows": out})
+
 # --- Debug: list admin routes so we know which exporter is actually wired ---
 @admin_bp.get("/debug/routes")
 def admin_debug_routes():
@@ -330,6 +1111,12 @@ def admin_debug_routes():
             })
     return jsonify({"routes": rules}), 200
 
+# --- Debug: per-process recall cache counters ---
+@admin_bp.get("/debug/recall-cache")
+def admin_debug_recall_cache():
+    _require_admin_token()
+    return jsonify({"pid": os.getpid(), **recall_cache_stats()}), 200
+
 # --- Debug: DB check — driver, table list, counts, columns (no streaming) ---
 @admin_bp.get("/debug/dbcheck")
 def admin_debug_dbcheck():
@@ -368,7 +1155,7 @@ def admin_export_transcript(tid):
       id,transcript_id,role,created_at,usage_input,usage_output,usage_total,content
     """
     _require_admin_token()
-    s = _readonly_session()
+    s = _admin_session()
     try:
         tr = s.query(Transcript).get(tid)
         if not tr:
@@ -377,6 +1164,8 @@ def admin_export_transcript(tid):
         q = (s.query(TranscriptMessage)
                .filter(TranscriptMessage.transcript_id == tid)
                .order_by(TranscriptMessage.created_at.asc()))
+        # archived (older) messages first, then whatever is still in the hot table
+        archived = [SimpleNamespace(**d) for d in archived_messages(s, tr)]
 
         def gen():
             buff = io.StringIO()
@@ -387,7 +1176,7 @@ def admin_export_transcript(tid):
             ])
             yield buff.getvalue(); buff.seek(0); buff.truncate(0)
 
-            for m in q:
+            for m in itertools.chain(archived, q):
                 content = (m.content or "").replace("\r", " ").replace("\n", "\\n")
                 w.writerow([
                     m.id, m.transcript_id, m.role,
@@ -422,39 +1211,144 @@ def admin_ban(uid):
 
 @admin_bp.get("/export-all.csv")
 def admin_export_all():
-    """Download all whitelisted tables as one CSV file."""
+    """
+    Download all whitelisted tables as one CSV file: a "### <table>" line, the header
+    row, then the rows, per table; archived messages follow as transcript_messages_archived.
+    Rows come in primary-key order, EXPORT_CHUNK_ROWS at a time, each chunk on a short
+    read of its own, so memory stays flat and no read transaction spans the download.
+    Gzipped on the fly when the client accepts it.
+
+    Resume: ?table=<table>&after=<primary key of the last row received> continues after
+    that row and through the remaining tables. Composite keys (usage_ledger, archives) go
+    as a JSON array, e.g. after=["<user_id>","2025-01","peter"].
+    """
     _require_admin_token()
 
-    def stream_all():
-        import datetime as _dt
-        for name, tbl in _TABLES.items():
-            cols = [c.name for c in tbl.columns]
-
-            # Section header
-            yield f"### {name}\r\n"
-            yield ",".join(cols) + "\r\n"
-
-            sql = text(f'SELECT {", ".join([f"""\"{c}\"""" for c in cols])} FROM "{tbl.name}"')
-            with engine.connect() as conn:
-                for row in conn.execute(sql):
-                    vals = []
-                    for v in row:
-                        if v is None:
-                            vals.append("")
-                        elif isinstance(v, (_dt.datetime, _dt.date, _dt.time)):
-                            vals.append(v.isoformat())
-                        else:
-                            vals.append(str(v))
-                    yield ",".join(vals) + "\r\n"
-
-            # spacer between tables
-            yield "\r\n"
-
-    resp = Response(stream_all(), mimetype="text/csv")
+    names = list(_TABLES) + [_ARCHIVED_SECTION]
+    table = request.args.get("table")
+    if table and table not in names:
+        return jsonify({"ok": False, "error": f"Unknown table {table!r}; one of {', '.join(names)}"}), 400
+    after = request.args.get("after")
+    if after is not None:
+        if not table:
+            return jsonify({"ok": False, "error": "after: needs table= (the table the key belongs to)"}), 400
+        try:
+            after = json.loads(after) if after.startswith("[") else [after]
+        except ValueError:
+            return jsonify({"ok": False, "error": "after: expected a key or a JSON array"}), 400
+        # checked here: an error inside the stream would only show up as a truncated file
+        pk = ["user_id", "month_key"] if table == _ARCHIVED_SECTION \
+            else [c.name for c in _TABLES[table].primary_key.columns]
+        if not isinstance(after, list) or len(after) != len(pk) \
+                or not all(isinstance(v, (str, int, float)) for v in after):
+            return jsonify({"ok": False, "error": f"after: {table} is keyed by {pk}; give "
+                            + ("one value" if len(pk) == 1 else f"a JSON array of {len(pk)} values")}), 400
+    start = names.index(table) if table else 0
+    eng = _admin_engine()
+
+    def rows_csv():
+        buff = io.StringIO()
+        w = csv.writer(buff, lineterminator="\r\n")
+        for i, name in enumerate(names[start:]):
+            cursor = after if i == 0 else None
+            if name == _ARCHIVED_SECTION:
+                cols, chunks = ["user_id", "month_key"] + _ARCHIVE_FIELDS, _export_archived_chunks(eng, cursor)
+            else:
+                tbl = _TABLES[name]
+                cols, chunks = [c.name for c in tbl.columns], _export_chunks(eng, tbl, cursor)
+            buff.write(f"### {name}\r\n")
+            w.writerow(cols)
+            for rows in chunks:
+                for row in rows:
+                    w.writerow(["" if v is None else v.isoformat() if isinstance(v, (dt.datetime, dt.date)) else v
+                                for v in row])
+                yield buff.getvalue(); buff.seek(0); buff.truncate(0)
+            buff.write("\r\n")   # spacer between tables
+        yield buff.getvalue()
+
+    body = (part.encode("utf-8") for part in rows_csv())
+    resp = Response(mimetype="text/csv")
+    if request.accept_encodings["gzip"]:
+        body = _gzip_stream(body)
+        resp.headers["Content-Encoding"] = "gzip"
+    resp.vary.add("Accept-Encoding")
+    resp.response = body
     resp.headers["Content-Disposition"] = 'attachment; filename="all_tables.csv"'
     return resp
 
 
+from sqlalchemy import select, tuple_
+
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000"))
+_ARCHIVED_SECTION = "transcript_messages_archived"
+
+def _export_chunks(eng, tbl, after=None):
+    """Keyset pages of tbl in primary-key order, starting after the key `after` (list)."""
+    pk = list(tbl.primary_key.columns)
+    cols = list(tbl.columns)
+    pk_pos = [cols.index(c) for c in pk]
+    while True:
+        q = select(*cols).order_by(*pk).limit(EXPORT_CHUNK_ROWS)
+        if after is not None:
+            q = q.where(tuple_(*pk) > tuple_(*after) if len(pk) > 1 else pk[0] > after[0])
+        with eng.connect() as conn:   # one short read per chunk
+            rows = conn.execute(q).all()
+        if rows:
+            yield rows
+        if len(rows) < EXPORT_CHUNK_ROWS:
+            return
+        after = [rows[-1][i] for i in pk_pos]
+
+def _export_archived_chunks(eng, after=None):
+    """Archived messages, one archive (user+month) per chunk, keyed by (user_id, month_key)."""
+    pk = [TranscriptArchive.user_id, TranscriptArchive.month_key]
+    while True:
+        q = select(TranscriptArchive.user_id, TranscriptArchive.month_key, TranscriptArchive.blob)\
+                .order_by(*pk).limit(1)
+        if after is not None:
+            q = q.where(tuple_(*pk) > tuple_(*after))
+        with eng.connect() as conn:
+            arc = conn.execute(q).first()
+        if arc is None:
+            return
+        yield [[arc.user_id, arc.month_key] + [d.get(f) for f in _ARCHIVE_FIELDS]
+               for d in _unpack_messages(arc.blob)]
+        after = [arc.user_id, arc.month_key]
+
+def _gzip_stream(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)   # wbits 31 = gzip container
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
+
+
+@admin_bp.get("/snapshots")
+def admin_snapshots():
+    """Snapshot files, newest first (?source=snapshot on read endpoints uses the first)."""
+    return jsonify({"snapshots": [{"name": os.path.basename(p), "bytes": os.path.getsize(p)}
+                                  for p in list_snapshots()]})
+
+@admin_bp.post("/snapshots")
+def admin_take_snapshot():
+    """Start a snapshot in the background (it paces itself); poll GET /admin/snapshots."""
+    with host_lock("snapshot", blocking=False) as free:   # a hint; take_snapshot re-checks
+        if _snapshot_lock.locked() or not free:
+            return jsonify({"ok": False, "error": "A snapshot is already running"}), 409
+    threading.Thread(target=take_snapshot, name="db-snapshot-once", daemon=True).start()
+    return jsonify({"ok": True}), 202
+
+@admin_bp.get("/snapshots/<name>")
+def admin_download_snapshot(name):
+    """Download a snapshot file ("latest" for the newest); supports Range / If-Range for resuming."""
+    snaps = list_snapshots()
+    path = snaps[0] if (name == "latest" and snaps) else os.path.join(SNAPSHOT_DIR, os.path.basename(name))
+    if path not in snaps:
+        raise SnapshotMissing()
+    return send_file(path, mimetype="application/vnd.sqlite3", as_attachment=True,
+                     download_name=os.path.basename(path), conditional=True, max_age=0)
+
 
 # Whitelist the tables you want exportable
 _TABLES = {
@@ -464,6 +1358,7 @@ _TABLES = {
     "transcript_messages": TranscriptMessage.__table__,
     "user_profiles": UserProfile.__table__,
     "memories": Memory.__table__,
+    "usage_ledger": UsageLedger.__table__,
 }
 
 
@@ -473,27 +1368,148 @@ app.register_blueprint(admin_bp)
 # Helpers
 # -------------------------------
 
-# --- Simple column add if missing (SQLite-safe) ---
-def _add_column_if_missing(table, column_def_sql):
-    try:
-        with engine.connect() as conn:
-            cols = conn.execute(f"PRAGMA table_info({table});").fetchall()
-            existing = {c[1] for c in cols}
-            target = column_def_sql.split()[0]
-            if target not in existing:
-                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column_def_sql};")
-    except Exception:
-        # ignore; in worst case you'll need a one-time migration
-        pass
-
-_add_column_if_missing("users", "abuse_count INTEGER NOT NULL DEFAULT 0")
-_add_column_if_missing("users", "is_banned BOOLEAN NOT NULL DEFAULT 0")
-
 def db(): return SessionLocal()
 def new_id(): return str(uuid.uuid4())
 def month_key_utc(d=None): return (d or dt.datetime.utcnow()).strftime("%Y-%m")
 def get_current_user_id(): return session.get("uid")
 
+# -------------------------------
+# Write-behind: one writer thread per process, group commits
+# -------------------------------
+#   WRITE_MODE=direct  each request commits its own writes (default)
+#   WRITE_MODE=group   writes queue up for one writer thread, which commits many requests'
+#                      writes in one transaction; the request waits for that commit (durable)
+#   WRITE_MODE=async   as group, but fire-and-forget writes (wait=False) return at once;
+#                      a crash can lose what is still queued
+# Reads stay direct. Compare: DB_FILE=/tmp/bench.sqlite3 flask --app app_db bench-writes
+import queue, atexit
+from concurrent.futures import Future
+
+WRITE_MODE      = os.getenv("WRITE_MODE", "direct").lower()
+WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", "64"))     # jobs per group commit
+WRITE_LINGER_MS = float(os.getenv("WRITE_LINGER_MS", "2"))    # wait this long for more jobs to join a group
+
+_write_q = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+def run_write(fn, wait=True):
+    """
+    Run fn(session) in a write transaction and return its result; fn must not commit.
+    Direct mode runs it now. Otherwise it is queued for the writer thread and the caller
+    waits for the group commit, unless WRITE_MODE=async and wait=False (returns None).
+    """
+    if WRITE_MODE not in ("group", "async"):
+        with db() as s:
+            out = fn(s)
+            s.commit()
+            return out
+    _ensure_writer()
+    f = Future()
+    _write_q.put((fn, f))
+    if wait or WRITE_MODE != "async":
+        return f.result()
+    return None
+
+def flush_writes():
+    """Block until everything queued so far is committed (the queue is FIFO)."""
+    if _writer_thread is not None and _writer_thread.is_alive():
+        f = Future()
+        _write_q.put((lambda s: None, f))
+        f.result()
+
+atexit.register(flush_writes)
+
+def _ensure_writer():
+    global _writer_thread
+    if _writer_thread is not None and _writer_thread.is_alive():
+        return
+    with _writer_lock:
+        # (threads don't survive a fork, so each worker process starts its own)
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+            _writer_thread.start()
+
+def _writer_loop():
+    while True:
+        jobs = [_write_q.get()]
+        deadline = time.monotonic() + WRITE_LINGER_MS / 1000.0
+        while len(jobs) < WRITE_BATCH_MAX:
+            try:
+                jobs.append(_write_q.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        _commit_group(jobs)
+
+def _commit_group(jobs):
+    try:
+        with db() as s:
+            results = [fn(s) for fn, _f in jobs]
+            s.commit()
+    except Exception:
+        # one bad job must not sink the rest of the group: replay each on its own
+        for fn, f in jobs:
+            try:
+                with db() as s:
+                    out = fn(s)
+                    s.commit()
+                f.set_result(out)
+            except Exception as e:
+                print(f"[WRITE] job failed: {e}", flush=True)
+                f.set_exception(e)
+        return
+    for (_fn, f), out in zip(jobs, results):
+        f.set_result(out)
+
+
+@app.cli.command("bench-writes")
+@click.option("--turns", default=2000, help="Simulated post-model writes (usage bump + assistant message).")
+@click.option("--threads", default=16, help="Concurrent request threads.")
+def bench_writes_cmd(turns, threads):
+    """Compare WRITE_MODEs on this DB (point DB_FILE at a scratch copy): flask --app app_db bench-writes"""
+    global WRITE_MODE
+    uid, tid = new_id(), new_id()
+    run_write(lambda s: s.add_all([User(id=uid),
+                                   Transcript(id=tid, user_id=uid, character="bench", month_key=month_key_utc())]))
+
+    def turn(s):
+        bump_totals(s, tid, 100, 20, 120, commit=False)
+        save_msg(s, tid, "assistant", "x" * 400, commit=False)
+
+    saved = WRITE_MODE
+    try:
+        for mode in ("direct", "group", "async"):
+            WRITE_MODE = mode
+            lat, errors = [], []
+
+            def worker(n):
+                for _ in range(n):
+                    t = time.perf_counter()
+                    try:
+                        run_write(turn, wait=False)
+                    except Exception as e:
+                        errors.append(e)
+                    lat.append(time.perf_counter() - t)
+
+            t0 = time.perf_counter()
+            workers = [threading.Thread(target=worker, args=(turns // threads,)) for _ in range(threads)]
+            for w in workers: w.start()
+            for w in workers: w.join()
+            flush_writes()
+            elapsed = time.perf_counter() - t0
+            lat.sort()
+            print(f"[BENCH] {mode:6}  {len(lat) / elapsed:7.0f} turns/s   "
+                  f"p50 {lat[len(lat) // 2] * 1000:6.2f} ms   p95 {lat[int(len(lat) * 0.95)] * 1000:6.2f} ms   "
+                  f"errors {len(errors)}")
+    finally:
+        WRITE_MODE = saved
+        with db() as s:
+            s.query(TranscriptMessage).filter(TranscriptMessage.transcript_id == tid).delete(synchronize_session=False)
+            s.query(UsageLedger).filter(UsageLedger.user_id == uid).delete(synchronize_session=False)
+            s.query(Transcript).filter(Transcript.id == tid).delete(synchronize_session=False)
+            s.query(User).filter(User.id == uid).delete(synchronize_session=False)
+            s.commit()
+
 TAG_RE = re.compile(r"\n⟦MODERATION:(ABUSE_WARN|ABUSE_BAN|SELF_HARM_URGENT|SELF_HARM_SUPPORT|LEGAL_DISCLOSURE)⟧\s*$")
 
 # Exact fixed lines, used to sanity-check the tag really belongs here
@@ -543,74 +1559,105 @@ def parse_moderation_tag(text: str):
 
 
 def ensure_guest_user():
-    with db() as s:
-        if session.get("uid"):
-            session.permanent = True          # keep cookie across restarts
-            return session["uid"]
-
-        u = User(id=new_id(), email=None)
-        s.add(u); s.commit()
-
-        ses = WebSession(
-            id=new_id(), user_id=u.id,
-            created_at=dt.datetime.utcnow(),
-            expires_at=dt.datetime.utcnow() + dt.timedelta(
-                days=int(os.getenv("GUEST_SESSION_DAYS", "7"))
-            )
-        )
-        s.add(ses); s.commit()
+    if session.get("uid"):
+        session.permanent = True          # keep cookie across restarts
+        return session["uid"]
 
-        session["uid"] = u.id
-        session["sid"] = ses.id
-        session.permanent = True              # ← important
-        return u.id
+    uid, sid = new_id(), new_id()
+    expires_at = dt.datetime.utcnow() + dt.timedelta(days=int(os.getenv("GUEST_SESSION_DAYS", "7")))
+    # one commit for both rows
+    run_write(lambda s: s.add_all([
+        User(id=uid, email=None),
+        WebSession(id=sid, user_id=uid, created_at=dt.datetime.utcnow(), expires_at=expires_at),
+    ]))
+
+    session["uid"] = uid
+    session["sid"] = sid
+    session["sexp"] = _epoch(expires_at)
+    session.permanent = True              # ← important
+    return uid
 
 
 def monthly_usage(s, user_id, mk):
+    # usage_ledger has one row per character, so this is a tiny PK-range read
     rows = s.query(
-        func.coalesce(func.sum(Transcript.token_input), 0),
-        func.coalesce(func.sum(Transcript.token_output), 0),
-        func.coalesce(func.sum(Transcript.token_total), 0),
-    ).filter(Transcript.user_id == user_id, Transcript.month_key == mk).one()
+        func.coalesce(func.sum(UsageLedger.token_input), 0),
+        func.coalesce(func.sum(UsageLedger.token_output), 0),
+        func.coalesce(func.sum(UsageLedger.token_total), 0),
+    ).filter(UsageLedger.user_id == user_id, UsageLedger.month_key == mk).one()
     return {"input": rows[0], "output": rows[1], "total": rows[2]}
 
-def find_or_create_transcript(s, user_id, character, mk):
-    tr = (s.query(Transcript)
-            .filter_by(user_id=user_id, character=character, month_key=mk)
-            .order_by(Transcript.started_at.desc())
-            .first())
+# The write helpers below commit by default. Pass commit=False to batch several
+# writes into the caller's transaction (one fsync instead of one per helper).
+def transcript_for_month_query(s, user_id, character, mk):
+    return (s.query(Transcript)
+              .filter_by(user_id=user_id, character=character, month_key=mk)
+              .order_by(Transcript.started_at.desc()))
+
+def find_or_create_transcript(s, user_id, character, mk, commit=True):
+    tr = transcript_for_month_query(s, user_id, character, mk).first()
     if tr is None:
         tr = Transcript(id=new_id(), user_id=user_id, character=character,
                         month_key=mk, started_at=dt.datetime.utcnow())
-        s.add(tr); s.commit()
+        s.add(tr)
+        if commit: s.commit()
     return tr
 
-def save_msg(s, tr_id, role, content, uin=0, uout=0, utot=0):
+def save_msg(s, tr_id, role, content, uin=0, uout=0, utot=0, commit=True, ucached=0, created_at=None,
+             turn_query=None):
     m = TranscriptMessage(
         id=new_id(), transcript_id=tr_id, role=role, content=content,
-        usage_input=uin, usage_output=uout, usage_total=utot
+        created_at=created_at or dt.datetime.utcnow(),   # sub-second, so turns in the same second keep their order
+        usage_input=uin, usage_output=uout, usage_total=utot, usage_cached=ucached
     )
-    s.add(m); s.commit()
-
-def bump_totals(s, tr_id, uin, uout, utot):
-    tr = s.query(Transcript).get(tr_id)
-    if not tr: return
-    tr.token_input += int(uin or 0)
-    tr.token_output += int(uout or 0)
-    tr.token_total += int(utot or 0)
-    s.commit()
-
-def get_or_create_profile(s, user_id, character):
+    s.add(m)
+    s.flush()   # autoflush is off and the transcript row may still be pending (first turn of the month)
+    # counters for the admin transcript browser; single UPDATE like bump_totals
+    s.query(Transcript).filter(Transcript.id == tr_id).update({
+        Transcript.message_count: Transcript.message_count + 1,
+        Transcript.last_message_at: m.created_at,
+    }, synchronize_session=False)
+    # recall searches user/assistant turns only; turn_query: the /api/ask turn this message belongs to
+    if role in ("user", "assistant"):
+        tr = s.get(Transcript, tr_id)   # usually already in the session's identity map
+        if tr:
+            after_commit(s, invalidate_recall, tr.user_id, tr.character, kind="msg", content=content,
+                         tr_id=tr_id, keep_query=turn_query)
+    if commit: s.commit()
+
+_LEDGER_UPSERT = text("""
+    INSERT INTO usage_ledger (user_id, month_key, character, token_input, token_output, token_total)
+    SELECT user_id, month_key, character, :uin, :uout, :utot FROM transcripts WHERE id = :tid
+    ON CONFLICT (user_id, month_key, character) DO UPDATE SET
+        token_input  = token_input  + excluded.token_input,
+        token_output = token_output + excluded.token_output,
+        token_total  = token_total  + excluded.token_total
+""")
+
+def bump_totals(s, tr_id, uin, uout, utot, commit=True):
+    # Single UPDATE (no read-modify-write), so it can open a write transaction directly
+    uin, uout, utot = int(uin or 0), int(uout or 0), int(utot or 0)
+    s.query(Transcript).filter(Transcript.id == tr_id).update({
+        Transcript.token_input: Transcript.token_input + uin,
+        Transcript.token_output: Transcript.token_output + uout,
+        Transcript.token_total: Transcript.token_total + utot,
+    }, synchronize_session=False)
+    # Same transaction: keep the monthly ledger in step
+    s.execute(_LEDGER_UPSERT, {"tid": tr_id, "uin": uin, "uout": uout, "utot": utot})
+    if commit: s.commit()
+
+def get_or_create_profile(s, user_id, character, commit=True):
     p = (s.query(UserProfile)
            .filter(UserProfile.user_id == user_id, UserProfile.character == character)
            .one_or_none())
     if p:
         p.last_seen = dt.datetime.utcnow()
-        s.commit()
+        if commit: s.commit()
         return p
     p = UserProfile(id=new_id(), user_id=user_id, character=character,
                     first_seen=dt.datetime.utcnow(), last_seen=dt.datetime.utcnow())
-    s.add(p); s.commit()
+    s.add(p)
+    if commit: s.commit()
     return p
 
 def merge_profile_json(old_json_str, updates_dict):
@@ -623,9 +1670,10 @@ def merge_profile_json(old_json_str, updates_dict):
         old[k] = v
     return _json.dumps(old, ensure_ascii=False)
 
-def add_memories(s, user_id, character, transcript_id, items):
+def add_memories(s, user_id, character, transcript_id, items, commit=True):
     """items: list of dicts: {kind,title,content,tags,importance,follow_up_after}"""
     count = 0
+    added = []
     for it in (items or []):
         faa = None
         if it.get("follow_up_after"):
@@ -649,9 +1697,13 @@ def add_memories(s, user_id, character, transcript_id, items):
 
         if m.content:
             s.add(m)
+            added.append(m)
             count += 1
 
-    s.commit()
+    index_memory_vectors(s, added)   # same transaction: new memories are searchable at once
+    after_commit(s, invalidate_memory_vectors, user_id, character)
+    after_commit(s, invalidate_recall, user_id, character, kind="mem")
+    if commit: s.commit()
     return count
 
 
@@ -662,8 +1714,39 @@ def merge_user_data(s, old_uid, new_uid):
     moved = 0
     moved += s.query(Transcript).filter(Transcript.user_id == old_uid)\
         .update({Transcript.user_id: new_uid}, synchronize_session=False)
+    # carry the guest's ledger rows over (adding to any the account already has)
+    s.execute(text("""
+        INSERT INTO usage_ledger (user_id, month_key, character, token_input, token_output, token_total)
+        SELECT :new, month_key, character, token_input, token_output, token_total
+        FROM usage_ledger WHERE user_id = :old
+        ON CONFLICT (user_id, month_key, character) DO UPDATE SET
+            token_input  = token_input  + excluded.token_input,
+            token_output = token_output + excluded.token_output,
+            token_total  = token_total  + excluded.token_total
+    """), {"old": old_uid, "new": new_uid})
+    s.query(UsageLedger).filter(UsageLedger.user_id == old_uid).delete(synchronize_session=False)
+    # and the daily rollup, so the account's usage history includes its guest days
+    s.execute(text("""
+        INSERT INTO usage_daily (day, user_id, character, token_input, token_output, token_total, message_count)
+        SELECT day, :new, character, token_input, token_output, token_total, message_count
+        FROM usage_daily WHERE user_id = :old
+        ON CONFLICT (day, user_id, character) DO UPDATE SET
+            token_input   = token_input   + excluded.token_input,
+            token_output  = token_output  + excluded.token_output,
+            token_total   = token_total   + excluded.token_total,
+            message_count = message_count + excluded.message_count
+    """), {"old": old_uid, "new": new_uid})
+    s.query(UsageDaily).filter(UsageDaily.user_id == old_uid).delete(synchronize_session=False)
+    # archived months are keyed by user too; a month the account already has gets one merged blob
+    for arc in s.query(TranscriptArchive).filter(TranscriptArchive.user_id == old_uid).all():
+        rows = [tuple(d[f] for f in _ARCHIVE_FIELDS) for d in _unpack_messages(arc.blob)]
+        s.delete(arc)
+        s.flush()
+        _store_archive(s, new_uid, arc.month_key, rows)
     moved += s.query(Memory).filter(Memory.user_id == old_uid)\
         .update({Memory.user_id: new_uid}, synchronize_session=False)
+    s.query(MemoryVector).filter(MemoryVector.user_id == old_uid)\
+        .update({MemoryVector.user_id: new_uid}, synchronize_session=False)
     moved += s.query(UserProfile).filter(UserProfile.user_id == old_uid)\
         .update({UserProfile.user_id: new_uid}, synchronize_session=False)
     try:
@@ -673,11 +1756,19 @@ def merge_user_data(s, old_uid, new_uid):
     except Exception:
         pass
     s.commit()
+    invalidate_memory_vectors(old_uid)
+    invalidate_memory_vectors(new_uid)
+    invalidate_recall(old_uid)
+    invalidate_recall(new_uid)
     return moved
 
 # -------------------------------
-# Prompts loader (robust)
+# Prompts loader (robust) + in-memory character registry
 # -------------------------------
+import threading, hashlib, glob, time
+
+CHARACTER_RELOAD_CHECK_SECS = float(os.getenv("CHARACTER_RELOAD_CHECK_SECS", "2"))
+
 def _read_if_exists(path):
     try:
         with open(path, "r", encoding="utf-8") as f:
@@ -685,15 +1776,115 @@ def _read_if_exists(path):
     except FileNotFoundError:
         return None
 
-def load_prompt(character):
+def _first_existing(*paths):
+    for p in paths:
+        if os.path.isfile(p):
+            return p
+    return None
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+
+try:
+    import tiktoken  # optional; falls back to a ~4 chars/token estimate
+    _ENCODER = tiktoken.encoding_for_model("gpt-4o")
+except Exception as e:
+    _ENCODER = None
+    print(f"[TOKENS] tiktoken unavailable ({e}); history budgets use a ~4 chars/token estimate", flush=True)
+
+import functools
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text):
+    # cached: history turns and prompts are re-counted on every chat turn
+    if not text:
+        return 0
+    if _ENCODER is not None:
+        return len(_ENCODER.encode(text))
+    return max(1, math.ceil(len(text) / 4))
+
+MSG_OVERHEAD_TOKENS = 4   # per-message framing in the chat format (role, separators)
+
+_CHAR_RE = re.compile(r"^#\s*Character:\s*(.+?)\s*$", re.MULTILINE)
+_CHARACTERS = {}            # slug -> entry dict (see _load_character)
+_CHARACTERS_CHECKED = 0.0   # monotonic time of the last mtime sweep
+_characters_lock = threading.Lock()
+
+def _prompt_paths(character):
     # try prompts/ & characters/ first, then root fallbacks
-    general = _read_if_exists(os.path.join(BASE_DIR, "prompts", "generic_prompt.md")) \
-           or _read_if_exists(os.path.join(BASE_DIR, "generic_prompt.md"))
-    specific = _read_if_exists(os.path.join(BASE_DIR, "characters", f"{character}.md")) \
-           or _read_if_exists(os.path.join(BASE_DIR, f"{character}.md"))
+    general = _first_existing(os.path.join(BASE_DIR, "prompts", "generic_prompt.md"),
+                              os.path.join(BASE_DIR, "generic_prompt.md"))
+    specific = _first_existing(os.path.join(BASE_DIR, "characters", f"{character}.md"),
+                               os.path.join(BASE_DIR, f"{character}.md"))
+    return general, specific
+
+def _character_slugs():
+    slugs = {os.path.splitext(os.path.basename(p))[0]
+             for p in glob.glob(os.path.join(BASE_DIR, "characters", "*.md"))}
+    slugs.update(CHARACTER_VOICE_MAP.keys())
+    return sorted(slugs)
+
+def _load_character(character):
+    general_path, specific_path = _prompt_paths(character)
+    general = _read_if_exists(general_path) if general_path else None
+    specific = _read_if_exists(specific_path) if specific_path else None
     if not (general and specific):
         return None
-    return f"{general}\n\n{specific}"
+    system_prompt = f"{general}\n\n{specific}"
+    m = _CHAR_RE.search(specific)
+    return {
+        "slug": character,
+        "name": m.group(1) if m else character.replace("_", " ").title(),
+        "voice": CHARACTER_VOICE_MAP.get(character),
+        "system_prompt": system_prompt,
+        "prompt_tokens": count_tokens(system_prompt),
+        "paths": (general_path, specific_path),
+        "mtimes": (_mtime(general_path), _mtime(specific_path)),
+    }
+
+def _refresh_characters(force=False):
+    """Re-stat the prompt files (at most every CHARACTER_RELOAD_CHECK_SECS) and reload changed ones."""
+    global _CHARACTERS, _CHARACTERS_CHECKED
+    now = time.monotonic()
+    if not force and now - _CHARACTERS_CHECKED < CHARACTER_RELOAD_CHECK_SECS:
+        return
+    with _characters_lock:
+        if not force and now - _CHARACTERS_CHECKED < CHARACTER_RELOAD_CHECK_SECS:
+            return
+        fresh = {}
+        for slug in _character_slugs():
+            entry = _CHARACTERS.get(slug)
+            if entry and entry["paths"] == _prompt_paths(slug) \
+                    and entry["mtimes"] == tuple(_mtime(p) for p in entry["paths"]):
+                fresh[slug] = entry
+                continue
+            entry = _load_character(slug)
+            if entry:
+                fresh[slug] = entry
+        _CHARACTERS = fresh   # one rebind: readers without the lock see the old dict or the new one
+        _CHARACTERS_CHECKED = now
+
+def get_character(character):
+    _refresh_characters()
+    return _CHARACTERS.get(character)
+
+def list_characters():
+    _refresh_characters()
+    chars = _CHARACTERS
+    return [chars[k] for k in sorted(chars)]
+
+def characters_etag():
+    parts = [f"{c['slug']}:{c['voice']}:{c['mtimes']}" for c in list_characters()]
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+def load_prompt(character):
+    entry = get_character(character)
+    return entry["system_prompt"] if entry else None
+
+_refresh_characters(force=True)
 
 # -------------------------------
 # About
@@ -706,6 +1897,113 @@ def about():
     except FileNotFoundError:
         return "No About content found."
 
+# -------------------------------
+# Metrics: Prometheus text format at /metrics (X-Admin-Token or Authorization: Bearer)
+# -------------------------------
+# Under gunicorn set PROMETHEUS_MULTIPROC_DIR to a directory all workers share: each
+# worker then writes its samples to its own mmap'd files and /metrics sums them
+# (gunicorn.conf.py clears the directory on start and marks dead workers). Without it
+# the numbers are per-process. Label children are resolved once and cached, so the hot
+# path is one uncontended per-value lock and no registry lookups.
+from contextlib import contextmanager
+from flask import g
+
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+if PROMETHEUS_MULTIPROC_DIR:
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+try:
+    import prometheus_client as prom   # optional; without it /metrics answers 501
+    from prometheus_client import multiprocess as prom_multiprocess
+except ImportError:
+    prom = None
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") or ADMIN_TOKEN
+_LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 20, 40, 80)
+# db_pre = everything before the model call (checks, recall, history, user-turn write);
+# persist = everything after it; llm/curator/tts/stt = the OpenAI calls themselves
+STAGES = ("db_pre", "checks", "recall", "history", "write", "llm", "persist", "curator", "tts", "stt")
+
+if prom is not None:
+    HTTP_SECONDS = prom.Histogram("http_request_duration_seconds", "Request latency by route (time to response headers)",
+                                  ["route", "method", "status"], buckets=_LATENCY_BUCKETS)
+    STAGE_SECONDS = prom.Histogram("chat_stage_duration_seconds", "Latency of the chat and voice stages",
+                                   ["stage"], buckets=_LATENCY_BUCKETS)
+    LLM_TOKENS = prom.Counter("llm_tokens", "Model tokens used", ["kind"])
+    MODERATION_TAGS = prom.Counter("moderation_tags", "Moderation tags in character replies", ["tag"])
+    CAP_HITS = prom.Counter("usage_cap_hits", "Turns refused at the monthly cap (cap) or crossing the warn threshold (warn)", ["kind"])
+    LLM_IN_FLIGHT = prom.Gauge("llm_in_flight", "OpenAI calls in progress", ["stage"], multiprocess_mode="livesum")
+    _stage_hist = {st: STAGE_SECONDS.labels(st) for st in STAGES}
+    _in_flight = {st: LLM_IN_FLIGHT.labels(st) for st in ("llm", "curator", "tts", "stt")}
+    _tokens = {k: LLM_TOKENS.labels(k) for k in ("input", "output", "cached")}
+    _http_hist = {}   # (route, method, status) -> child; a racing first insert is harmless
+
+def observe_stage(stage, seconds):
+    if prom is not None:
+        _stage_hist[stage].observe(seconds)
+
+def observe_stage_ms(timings):
+    """Feed a stage_ms dict from _ask_prepare (its "total" is the db_pre stage)."""
+    if prom is not None:
+        for stage, ms in timings.items():
+            _stage_hist["db_pre" if stage == "total" else stage].observe(ms / 1000.0)
+
+@contextmanager
+def model_call(stage):
+    """Time an OpenAI call as `stage` and count it in llm_in_flight while it runs."""
+    if prom is None:
+        yield
+        return
+    _in_flight[stage].inc()
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stage_hist[stage].observe(time.perf_counter() - t)
+        _in_flight[stage].dec()
+
+def count_usage(usage):
+    if prom is not None and usage is not None:
+        _tokens["input"].inc(usage.prompt_tokens or 0)
+        _tokens["output"].inc(usage.completion_tokens or 0)
+        _tokens["cached"].inc(cached_tokens(usage))
+
+def count_moderation_tag(tag):
+    if prom is not None:
+        MODERATION_TAGS.labels(tag).inc()
+
+def count_cap_hit(kind):
+    if prom is not None:
+        CAP_HITS.labels(kind).inc()
+
+@app.before_request
+def _metrics_start():
+    g.t_request = time.perf_counter()
+
+@app.after_request
+def _metrics_observe(resp):
+    t = g.pop("t_request", None)
+    if prom is not None and t is not None:
+        key = (request.url_rule.rule if request.url_rule else "<unmatched>", request.method, str(resp.status_code))
+        child = _http_hist.get(key)
+        if child is None:
+            child = _http_hist[key] = HTTP_SECONDS.labels(*key)
+        child.observe(time.perf_counter() - t)
+    return resp
+
+@app.get("/metrics")
+def metrics():
+    auth = request.headers.get("Authorization", "")
+    token = auth[7:] if auth.startswith("Bearer ") else request.headers.get("X-Admin-Token", "")
+    if not METRICS_TOKEN or not secrets.compare_digest(token, METRICS_TOKEN):
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    if prom is None:
+        return jsonify({"ok": False, "error": "prometheus_client is not installed"}), 501
+    registry = prom.REGISTRY
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = prom.CollectorRegistry()
+        prom_multiprocess.MultiProcessCollector(registry)
+    return Response(prom.generate_latest(registry), mimetype=prom.CONTENT_TYPE_LATEST)
+
 # -------------------------------
 # STT & TTS
 # -------------------------------
@@ -719,7 +2017,7 @@ def speech_to_text():
     temp_filename = f"temp/input_{_uuid.uuid4()}.webm"
     file.save(temp_filename)
     try:
-        with open(temp_filename, "rb") as f:
+        with open(temp_filename, "rb") as f, model_call("stt"):
             transcript = client.audio.transcriptions.create(
                 model="whisper-1", file=f, response_format="text"
             )
@@ -735,7 +2033,8 @@ def generate_tts():
     voice = data.get("voice", "shimmer")
     if not text:
         return jsonify({"error": "No text provided."}), 400
-    response = client.audio.speech.create(model="tts-1", voice=voice, input=text)
+    with model_call("tts"):
+        response = client.audio.speech.create(model="tts-1", voice=voice, input=text)
     return Response(response.content, mimetype="audio/mpeg")
 
 # -------------------------------
@@ -810,9 +2109,21 @@ def auth_start():
         ok = send_magic_link(email, link)
         return jsonify({"ok": bool(ok)})
 
+# Static files and health checks never touch the session (page loads fetch dozens of them)
+_SESSIONLESS_ENDPOINTS = {"static", "static_proxy", "assets", "healthz", "version", "metrics"}
+
+def _no_session_hooks():
+    return request.endpoint in _SESSIONLESS_ENDPOINTS
+
+def _epoch(ts):
+    # naive UTC datetime -> int seconds (the cookie is JSON; datetimes don't round-trip)
+    return int(ts.replace(tzinfo=dt.timezone.utc).timestamp())
+
 # Accept ?uid=... and merge guest history
 @app.before_request
 def check_uid_param():
+    if _no_session_hooks():
+        return
     uid_signed = request.args.get("uid")
     if uid_signed:
         try:
@@ -833,20 +2144,31 @@ def check_uid_param():
                                  expires_at=dt.datetime.utcnow() + dt.timedelta(days=int(os.getenv("SESSION_DAYS","7"))))
                 s.add(ses); s.commit()
                 session["sid"] = ses.id
+                session["sexp"] = _epoch(ses.expires_at)
                 session.permanent = True
         except BadSignature:
             pass
 
-# Enforce session expiry
+# Enforce session expiry.
+# The expiry travels in the signed cookie ("sexp"), so a live session costs no DB read;
+# only cookies from before that (no "sexp") are looked up once and then stamped.
 @app.before_request
 def enforce_session_expiry():
+    if _no_session_hooks():
+        return
     sid = session.get("sid")
     if not sid:
         return
-    with db() as s:
-        ses = s.query(WebSession).get(sid)
-        if not ses or ses.expires_at < dt.datetime.utcnow():
-            session.clear()
+    sexp = session.get("sexp")
+    if sexp is None:
+        with db() as s:
+            ses = s.query(WebSession).get(sid)
+            if not ses:
+                session.clear()
+                return
+            sexp = session["sexp"] = _epoch(ses.expires_at)
+    if sexp < _epoch(dt.datetime.utcnow()):
+        session.clear()
 
 @app.get("/logout")
 def logout():
@@ -910,101 +2232,953 @@ def api_trial():
 # -------------------------------
 @app.route("/")
 def index():
+    # Built copy (manifest inlined, precompressed) when `flask build-assets` has run
+    if os.path.exists(os.path.join(ASSET_DIR, "index.html")):
+        return _send_asset("index.html", immutable=False)
     return send_from_directory(STATIC_DIR, "index.html")
 
 @app.route("/api/voice-map")
 def get_voice_map():
     return jsonify(CHARACTER_VOICE_MAP)
 
+@app.get("/api/characters")
+def api_characters():
+    """Characters the server can actually talk as (prompt files present), with ETag revalidation."""
+    rows = [{
+        "slug": c["slug"],
+        "name": c["name"],
+        "voice": c["voice"] or "onyx",
+        "prompt_tokens": c["prompt_tokens"],
+    } for c in list_characters()]
+    resp = jsonify({"characters": rows})
+    resp.set_etag(characters_etag())
+    resp.headers["Cache-Control"] = "no-cache"   # always revalidate; 304 when unchanged
+    return resp.make_conditional(request)
+
 # -------------------------------
 # Recall helpers (memories-first)
 # -------------------------------
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+def _recall_terms(user_query):
+    # distinct non-trivial terms, in order of appearance
+    out = []
+    for t in _TERM_RE.findall(user_query.lower()):
+        if len(t) >= 4 and t not in out:
+            out.append(t)
+    return out[:5]
+
+def _fts_query(terms):
+    # each term as a quoted string: no FTS syntax from user input gets through
+    return " OR ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+def _fts_ids(s, sql, params):
+    # datetimes as SQLAlchemy stores them in SQLite, so text() comparisons line up
+    params = {k: (v.strftime("%Y-%m-%d %H:%M:%S.%f") if isinstance(v, dt.datetime) else v)
+              for k, v in params.items()}
+    return [row[0] for row in s.execute(text(sql), params)]
+
+def _in_order(rows, ids, key):
+    pos = {i: n for n, i in enumerate(ids)}
+    return sorted(rows, key=lambda r: pos[key(r)])
+
+# The FTS tables hold every user's rows, so MATCH alone would find and BM25-score all
+# of them before the owner filter. r is the rowid range of this user's candidate rows
+# (read from the owner indexes); the planner then drives from those rows, or hands the
+# range to FTS5 as a rowid bound.
+# BM25-ranked (title weighted over content), then importance/recency
+_MEMORIES_FTS_SQL = """
+    WITH r AS (SELECT MIN(rowid) AS lo, MAX(rowid) AS hi FROM memories
+               WHERE user_id = :uid AND character = :ch AND created_at >= :since)
+    SELECT m.id FROM r, memories_fts f JOIN memories m ON m.rowid = f.rowid
+    WHERE memories_fts MATCH :q AND f.rowid BETWEEN r.lo AND r.hi
+      AND m.user_id = :uid AND m.character = :ch AND m.created_at >= :since
+    ORDER BY bm25(memories_fts, 2.0, 1.0), m.importance DESC, m.created_at DESC
+    LIMIT :n"""
+
+def _like_memories_query(s, user_id, character, terms, since):
+    return (s.query(Memory)
+              .filter(
+                  Memory.user_id == user_id,
+                  Memory.character == character,
+                  Memory.created_at >= since,
+                  or_(*[Memory.content.ilike(f"%{t}%") for t in terms])
+              )
+              .order_by(Memory.importance.desc(), Memory.created_at.desc()))
+
+def _keyword_memories(s, user_id, character, terms, since, limit):
+    if FTS_ENABLED:
+        ids = _fts_ids(s, _MEMORIES_FTS_SQL, {"q": _fts_query(terms), "uid": user_id, "ch": character,
+                                              "since": since, "n": limit})
+        return _in_order(s.query(Memory).filter(Memory.id.in_(ids)).all(), ids, lambda m: m.id) if ids else []
+    return _like_memories_query(s, user_id, character, terms, since).limit(limit).all()
+
+# -------------------------------
+# Recall cache (per process): LRU + TTL, invalidated by the writes that change results
+# -------------------------------
+# Invalidation runs after the write commits (see after_commit), and only in the process
+# that wrote. Other workers keep serving their entry until RECALL_CACHE_TTL expires: that
+# per-worker staleness is the accepted limit (the write path stays free of a shared
+# generation counter); set RECALL_CACHE_TTL lower, or RECALL_CACHE_SIZE=0, to tighten it.
+from collections import OrderedDict
+
+RECALL_CACHE_SIZE = int(os.getenv("RECALL_CACHE_SIZE", "2048"))    # entries; 0 disables the cache
+RECALL_CACHE_TTL  = float(os.getenv("RECALL_CACHE_TTL", "300"))    # seconds; the staleness bound across workers
+
+# key -> (expires_at, hits, term_prefixes, transcript_ids)
+_recall_cache = OrderedDict()
+_recall_cache_lock = threading.Lock()
+RECALL_CACHE_STATS = {"mem_hits": 0, "mem_misses": 0, "msg_hits": 0, "msg_misses": 0, "invalidated": 0}
+
+def _recall_key(user_query, terms):
+    # keyword terms + the content words the embedder sees; order, case and stopwords don't change recall
+    return (tuple(sorted(terms)),
+            tuple(sorted({t for t in _TERM_RE.findall(user_query.lower())
+                          if len(t) >= 3 and t not in _STOPWORDS})) if SEMANTIC_ENABLED else ())
+
+def _prefixes(words):
+    # 4-char prefixes: a cheap stand-in for the FTS porter stems ("boat"/"boats", "fish"/"fishing")
+    return {w[:4] for w in words if len(w) >= 4}
+
+def _rc_get(key):
+    kind = key[0]
+    with _recall_cache_lock:
+        entry = _recall_cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            _recall_cache.move_to_end(key)
+            RECALL_CACHE_STATS[f"{kind}_hits"] += 1
+            return entry[1]
+        if entry:
+            del _recall_cache[key]
+        RECALL_CACHE_STATS[f"{kind}_misses"] += 1
+    return None
+
+def _rc_put(key, hits, prefixes=frozenset(), tr_ids=frozenset()):
+    if RECALL_CACHE_SIZE <= 0:
+        return
+    with _recall_cache_lock:
+        _recall_cache[key] = (time.monotonic() + RECALL_CACHE_TTL, list(hits), frozenset(prefixes), frozenset(tr_ids))
+        _recall_cache.move_to_end(key)
+        while len(_recall_cache) > RECALL_CACHE_SIZE:
+            _recall_cache.popitem(last=False)
+
+def invalidate_recall(user_id, character=None, kind=None, content=None, tr_id=None, keep_query=None):
+    """
+    Drop cached recall for a user (optionally one character / one kind: "mem" | "msg").
+    For "msg" with content/tr_id given, only entries the new message could change are
+    dropped: the query shares a term with it, or a cached snippet came from that transcript.
+    keep_query: the query of the turn writing the message. Its own entry is kept: that turn's
+    messages are in the prompt already, and the user turn always shares the query's terms,
+    so dropping it would leave the message-hit cache nothing to hit (TTL bounds the rest).
+    """
+    if not _recall_cache:
+        return
+    new_prefixes = _prefixes(_TERM_RE.findall(content.lower())) if content is not None else None
+    keep = _recall_key(keep_query, _recall_terms(keep_query)) if keep_query else None
+    with _recall_cache_lock:
+        for key, (_exp, _hits, prefixes, tr_ids) in list(_recall_cache.items()):
+            if key[1] != user_id or (character is not None and key[2] != character):
+                continue
+            if kind is not None and key[0] != kind:
+                continue
+            if keep is not None and key[3] == keep:
+                continue
+            if new_prefixes is not None and not (prefixes & new_prefixes) and tr_id not in tr_ids:
+                continue
+            del _recall_cache[key]
+            RECALL_CACHE_STATS["invalidated"] += 1
+
+def recall_cache_stats():
+    with _recall_cache_lock:
+        out = dict(RECALL_CACHE_STATS, size=len(_recall_cache), max_size=RECALL_CACHE_SIZE, ttl=RECALL_CACHE_TTL)
+    for kind in ("mem", "msg"):
+        total = out[f"{kind}_hits"] + out[f"{kind}_misses"]
+        out[f"{kind}_hit_ratio"] = round(out[f"{kind}_hits"] / total, 4) if total else 0.0
+    return out
+
 def retrieve_relevant_snippets(s, user_id, character, user_query, lookback_days=180, max_snippets=3):
     if not user_query or len(user_query.strip()) < 3:
         return []
     since = dt.datetime.utcnow() - dt.timedelta(days=lookback_days)
-    # take distinct non-trivial terms
-    terms = [t for t in set(user_query.lower().split()) if len(t) >= 4][:5]
-    if not terms: return []
-
+    terms = _recall_terms(user_query)
+    if not terms and not SEMANTIC_ENABLED: return []
+    qkey = _recall_key(user_query, terms)
+
+    # 1) Search memories first (changes only when memories do)
+    key = ("mem", user_id, character, qkey, lookback_days, max_snippets)
+    hits = _rc_get(key)
+    if hits is None:
+        hits = _memory_hits(s, user_id, character, user_query, terms, since, max_snippets)
+        _rc_put(key, hits)
+    if len(hits) >= max_snippets:
+        return list(hits)
+
+    # 2) Fallback to raw transcript messages (only as many hits as there are slots left)
+    if not terms:
+        return list(hits)
+    need = max_snippets - len(hits)
+    key = ("msg", user_id, character, qkey, lookback_days, need)
+    msg_hits = _rc_get(key)
+    if msg_hits is None:
+        msg_hits, tr_ids = _transcript_hits(s, user_id, character, terms, since, need)
+        _rc_put(key, msg_hits, _prefixes(terms), tr_ids)
+    return list(hits) + list(msg_hits)
+
+def _memory_hits(s, user_id, character, user_query, terms, since, max_snippets):
+    # semantic hits (if enabled), then keyword hits
+    mems = []
+    if SEMANTIC_ENABLED:
+        ids = semantic_memory_ids(s, user_id, character, user_query, since, max_snippets * 2)
+        mems = _in_order(s.query(Memory).filter(Memory.id.in_(ids)).all(), ids, lambda m: m.id) if ids else []
+    if terms and RECALL_MEMORY_MODE != "semantic" and len(mems) < max_snippets * 2:
+        have = {m.id for m in mems}
+        mems += [m for m in _keyword_memories(s, user_id, character, terms, since, max_snippets * 2)
+                 if m.id not in have][:max_snippets * 2 - len(mems)]
     hits = []
-
-    # 1) Search memories first
-    mem_q = (s.query(Memory)
-               .filter(
-                   Memory.user_id == user_id,
-                   Memory.character == character,
-                   Memory.created_at >= since,
-                   or_(*[Memory.content.ilike(f"%{t}%") for t in terms])
-               )
-               .order_by(Memory.importance.desc(), Memory.created_at.desc())
-               .limit(max_snippets*2))
-    for m in mem_q.all():
+    for m in mems:
         stamp = m.created_at.strftime("%Y-%m-%d")
         label = (m.title or m.kind or "memory")
         hits.append(f"[From {stamp} • {label}] {m.content[:700]}")
         if len(hits) >= max_snippets:
-            return hits
-
-    # 2) Fallback to raw transcript messages
-    q = (s.query(TranscriptMessage, Transcript)
-           .join(Transcript, TranscriptMessage.transcript_id == Transcript.id)
-           .filter(
-               Transcript.user_id == user_id,
-               Transcript.character == character,
-               Transcript.started_at >= since,
-               TranscriptMessage.role.in_(["user","assistant"]),
-               or_(*[TranscriptMessage.content.ilike(f"%{t}%") for t in terms])
-           )
-           .order_by(TranscriptMessage.created_at.desc())
-           .limit(30))
-    seen = set()
-    for m, tr in q.all():
-        key = (tr.id, m.created_at)
-        if key in seen: continue
-        seen.add(key)
-        prev_msg = (s.query(TranscriptMessage)
-                      .filter(TranscriptMessage.transcript_id == tr.id,
-                              TranscriptMessage.created_at < m.created_at)
-                      .order_by(TranscriptMessage.created_at.desc()).first())
-        next_msg = (s.query(TranscriptMessage)
-                      .filter(TranscriptMessage.transcript_id == tr.id,
-                              TranscriptMessage.created_at > m.created_at)
-                      .order_by(TranscriptMessage.created_at.asc()).first())
+            break
+    return hits
+
+_MESSAGES_FTS_SQL = """
+    WITH r AS (SELECT MIN(m.rowid) AS lo, MAX(m.rowid) AS hi
+               FROM transcripts t JOIN transcript_messages m ON m.transcript_id = t.id
+               WHERE t.user_id = :uid AND t.character = :ch AND t.started_at >= :since
+                 AND m.role IN ('user', 'assistant'))
+    SELECT m.id FROM r, transcript_messages_fts f
+    JOIN transcript_messages m ON m.rowid = f.rowid
+    JOIN transcripts t ON t.id = m.transcript_id
+    WHERE transcript_messages_fts MATCH :q AND f.rowid BETWEEN r.lo AND r.hi
+      AND t.user_id = :uid AND t.character = :ch AND t.started_at >= :since
+    ORDER BY bm25(transcript_messages_fts)
+    LIMIT :n"""
+
+def _like_messages_query(s, user_id, character, terms, since):
+    return (s.query(TranscriptMessage, Transcript)
+              .join(Transcript, TranscriptMessage.transcript_id == Transcript.id)
+              .filter(
+                  Transcript.user_id == user_id,
+                  Transcript.character == character,
+                  Transcript.started_at >= since,
+                  TranscriptMessage.role.in_(["user","assistant"]),
+                  or_(*[TranscriptMessage.content.ilike(f"%{t}%") for t in terms])
+              )
+              .order_by(TranscriptMessage.created_at.desc()))
+
+def _transcript_hits(s, user_id, character, terms, since, need):
+    """Returns (snippets, ids of the transcripts they came from)."""
+    if FTS_ENABLED:
+        ids = _fts_ids(s, _MESSAGES_FTS_SQL, {"q": _fts_query(terms), "uid": user_id, "ch": character,
+                                              "since": since, "n": need})
+        pairs = (s.query(TranscriptMessage, Transcript)
+                   .join(Transcript, TranscriptMessage.transcript_id == Transcript.id)
+                   .filter(TranscriptMessage.id.in_(ids)).all()) if ids else []
+        pairs = _in_order(pairs, ids, lambda p: p[0].id)
+    else:
+        pairs = _like_messages_query(s, user_id, character, terms, since).limit(need).all()
+    if not pairs:
+        return [], set()
+
+    # Neighbouring turns for every hit in one query (instead of 2 queries per hit)
+    around = _neighbours(s, [m.id for m, _ in pairs])
+    hits = []
+    for m, tr in pairs[:need]:
+        prev_role, prev_content, next_role, next_content = around.get(m.id, (None, None, None, None))
         lines = []
-        if prev_msg: lines.append(f"{prev_msg.role.capitalize()}: {prev_msg.content.strip()[:320]}")
+        if prev_role: lines.append(f"{prev_role.capitalize()}: {prev_content.strip()[:320]}")
         lines.append(f"{m.role.capitalize()} (match): {m.content.strip()[:480]}")
-        if next_msg: lines.append(f"{next_msg.role.capitalize()}: {next_msg.content.strip()[:320]}")
+        if next_role: lines.append(f"{next_role.capitalize()}: {next_content.strip()[:320]}")
         stamp = tr.started_at.strftime("%Y-%m-%d")
         hits.append(f"[From {stamp}] " + "\n".join(lines))
-        if len(hits) >= max_snippets: break
-    return hits
+    return hits, {tr.id for _, tr in pairs}
+
+# One bounded index seek (transcript_id, role, created_at) per hit, side and role: the
+# nearest earlier/later user and assistant turn. Ties on created_at (second-resolution
+# rows) go by rowid. Everything goes out as one UNION ALL, whatever the transcript length.
+_NEIGHBOUR_SEEK = """
+    SELECT * FROM (
+        SELECT :hit{i} AS hit, {step} AS step, role, content, created_at, rowid AS rid
+        FROM transcript_messages
+        WHERE transcript_id = :tid{i} AND role = '{role}' AND created_at {cmp}= :at{i}
+          AND (created_at {cmp} :at{i} OR rowid {cmp} :rid{i})
+        ORDER BY created_at {order}, rowid {order} LIMIT 1)"""
+
+_NEIGHBOUR_HITS = text("""
+    SELECT id, transcript_id, created_at, rowid FROM transcript_messages WHERE id IN :ids
+""").bindparams(bindparam("ids", expanding=True))
+
+def _neighbours(s, msg_ids):
+    """{message id: (prev_role, prev_content, next_role, next_content)}, user/assistant turns only."""
+    hits = s.execute(_NEIGHBOUR_HITS, {"ids": list(msg_ids)}).all()   # created_at as stored (text)
+    if not hits:
+        return {}
+    branches, params = [], {}
+    for i, (mid, tid, at, rid) in enumerate(hits):
+        params.update({f"hit{i}": mid, f"tid{i}": tid, f"at{i}": at, f"rid{i}": rid})
+        for step, cmp, order in ((-1, "<", "DESC"), (1, ">", "ASC")):
+            for role in ("user", "assistant"):
+                branches.append(_NEIGHBOUR_SEEK.format(i=i, step=step, role=role, cmp=cmp, order=order))
+    nearest = {}   # (hit, step) -> (role, content, created_at, rowid)
+    for hit, step, role, content, at, rid in s.execute(text(" UNION ALL ".join(branches)), params):
+        cur = nearest.get((hit, step))
+        if cur is None or ((at, rid) > cur[2:]) == (step < 0):
+            nearest[(hit, step)] = (role, content, at, rid)
+    out = {}
+    for mid, *_ in hits:
+        prev, nxt = nearest.get((mid, -1), (None, None)), nearest.get((mid, 1), (None, None))
+        out[mid] = (prev[0], prev[1], nxt[0], nxt[1])
+    return out
 
-def build_history(session_db, tr_id, system_prompt, max_turns=12, extra_system_text=None):
-    msgs = [{"role": "system", "content": system_prompt}]
-    if extra_system_text:
-        msgs.append({"role": "system", "content": extra_system_text})
-    rows = (session_db.query(TranscriptMessage)
+# -------------------------------
+# Semantic recall (offline): local embedder + per-(user, character) float32 index
+# -------------------------------
+import zlib, importlib
+
+try:
+    import numpy as np   # optional; without it recall stays keyword-only
+except ImportError:
+    np = None
+
+RECALL_MEMORY_MODE   = os.getenv("RECALL_MEMORY_MODE", "hybrid").lower()   # keyword | semantic | hybrid
+SEMANTIC_EMBEDDER    = os.getenv("SEMANTIC_EMBEDDER", "hashing")   # "hashing" or "package.module:factory"
+SEMANTIC_DIM         = int(os.getenv("SEMANTIC_DIM", "512"))
+SEMANTIC_MIN_SIM     = float(os.getenv("SEMANTIC_MIN_SIM", "0.18"))
+# score = W_SIM * cosine + W_IMPORTANCE * (importance-1)/4 + W_RECENCY * 0.5 ** (age_days / half-life)
+SEMANTIC_W_SIM        = float(os.getenv("SEMANTIC_W_SIM", "1.0"))
+SEMANTIC_W_IMPORTANCE = float(os.getenv("SEMANTIC_W_IMPORTANCE", "0.15"))
+SEMANTIC_W_RECENCY    = float(os.getenv("SEMANTIC_W_RECENCY", "0.1"))
+SEMANTIC_HALF_LIFE_DAYS = float(os.getenv("SEMANTIC_HALF_LIFE_DAYS", "30"))
+
+_STOPWORDS = frozenset("""
+    the and for are but not you your yours with this that have has had was were will would could should
+    from they them their there what when where which who whom why how about into over than then just
+    very really also been being its it's i'm i've don't can't our ours out all any some more most
+""".split())
+
+class HashingEmbedder:
+    """
+    Baseline embedder with no model files and no network: signed feature hashing of
+    words plus character trigrams, L2-normalised. Trigrams give partial credit for
+    shared stems ("mother"/"mothers", "pass"/"passed"); anything smarter plugs in via
+    SEMANTIC_EMBEDDER=module:factory returning an object with .name and .embed(texts).
+    """
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.name = f"hashing-v1-{dim}"
+
+    def _features(self, text):
+        for w in _TERM_RE.findall(text.lower()):
+            if len(w) < 3 or w in _STOPWORDS:
+                continue
+            yield "w:" + w, 1.0
+            padded = f"<{w}>"
+            for i in range(len(padded) - 2):
+                yield "c:" + padded[i:i + 3], 0.25
+
+    def embed(self, texts):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, t in enumerate(texts):
+            for feat, weight in self._features(t or ""):
+                h = zlib.crc32(feat.encode("utf-8"))      # stable across processes (unlike hash())
+                out[row, h % self.dim] += weight if (h >> 31) & 1 else -weight
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        return out / np.maximum(norms, 1e-9)
+
+def _load_embedder():
+    if np is None:
+        return None
+    if SEMANTIC_EMBEDDER == "hashing":
+        return HashingEmbedder(SEMANTIC_DIM)
+    mod, _, attr = SEMANTIC_EMBEDDER.partition(":")
+    return getattr(importlib.import_module(mod), attr or "embedder")()
+
+EMBEDDER = _load_embedder()
+SEMANTIC_ENABLED = EMBEDDER is not None and RECALL_MEMORY_MODE in ("semantic", "hybrid")
+
+def _memory_text(m):
+    return f"{m.title or ''}\n{m.content or ''}"
+
+def index_memory_vectors(s, memories):
+    """Embed new Memory rows and add their vectors to the session (caller commits)."""
+    if EMBEDDER is None or not memories:
+        return
+    vecs = EMBEDDER.embed([_memory_text(m) for m in memories]).astype(np.float32)
+    for m, v in zip(memories, vecs):
+        s.add(MemoryVector(memory_id=m.id, user_id=m.user_id, character=m.character,
+                           model=EMBEDDER.name, vec=v.tobytes()))
+
+# (user_id, character) -> {"sig", "ids", "mat", "importance", "created"}
+_VEC_CACHE = {}
+_vec_lock = threading.Lock()
+
+def invalidate_memory_vectors(user_id, character=None):
+    with _vec_lock:
+        for key in [k for k in _VEC_CACHE if k[0] == user_id and (character is None or k[1] == character)]:
+            _VEC_CACHE.pop(key, None)
+
+def _memory_matrix(s, user_id, character):
+    """The (user, character) matrix, reloaded only when its row set changed (checked via count + max rowid)."""
+    sig = tuple(s.execute(text("""
+        SELECT COUNT(*), MAX(rowid) FROM memory_vectors
+        WHERE user_id = :uid AND character = :ch AND model = :model
+    """), {"uid": user_id, "ch": character, "model": EMBEDDER.name}).one())
+    key = (user_id, character)
+    with _vec_lock:
+        entry = _VEC_CACHE.get(key)
+        if entry and entry["sig"] == sig:
+            return entry
+    rows = (s.query(MemoryVector.memory_id, MemoryVector.vec, Memory.importance, Memory.created_at)
+              .join(Memory, Memory.id == MemoryVector.memory_id)
+              .filter(MemoryVector.user_id == user_id, MemoryVector.character == character,
+                      MemoryVector.model == EMBEDDER.name)
+              .all())
+    entry = {
+        "sig": sig,
+        "ids": [r[0] for r in rows],
+        "mat": (np.frombuffer(b"".join(r[1] for r in rows), dtype=np.float32).reshape(len(rows), -1)
+                if rows else np.zeros((0, 1), dtype=np.float32)),
+        "importance": np.array([int(r[2] or 2) for r in rows], dtype=np.float32),
+        "created": np.array([r[3].timestamp() if r[3] else 0.0 for r in rows], dtype=np.float64),
+    }
+    with _vec_lock:
+        _VEC_CACHE[key] = entry
+    return entry
+
+def semantic_memory_ids(s, user_id, character, query, since, k):
+    """Top-k memory ids by blended score (similarity + importance + recency), best first."""
+    if not SEMANTIC_ENABLED:
+        return []
+    entry = _memory_matrix(s, user_id, character)
+    if not entry["ids"]:
+        return []
+    q = EMBEDDER.embed([query])[0]
+    sim = entry["mat"] @ q
+    now = dt.datetime.utcnow().timestamp()
+    age_days = np.maximum(0.0, (now - entry["created"]) / 86400.0)
+    score = (SEMANTIC_W_SIM * sim
+             + SEMANTIC_W_IMPORTANCE * (entry["importance"] - 1.0) / 4.0
+             + SEMANTIC_W_RECENCY * np.power(0.5, age_days / SEMANTIC_HALF_LIFE_DAYS))
+    ok = (sim >= SEMANTIC_MIN_SIM) & (entry["created"] >= since.timestamp())
+    score = np.where(ok, score, -np.inf)
+    k = min(k, int(ok.sum()))
+    if k <= 0:
+        return []
+    top = np.argpartition(-score, k - 1)[:k]
+    top = top[np.argsort(-score[top])]
+    return [entry["ids"][i] for i in top]
+
+def reindex_memory_vectors(batch=500):
+    """Embed every memory that has no vector for the current embedder. Returns the number indexed."""
+    if EMBEDDER is None:
+        return 0
+    done = 0
+    while True:
+        with db() as s:
+            missing = (s.query(Memory)
+                         .outerjoin(MemoryVector, (MemoryVector.memory_id == Memory.id)
+                                                  & (MemoryVector.model == EMBEDDER.name))
+                         .filter(MemoryVector.memory_id.is_(None))
+                         .limit(batch).all())
+            if not missing:
+                return done
+            # a vector from another embedder is replaced
+            s.query(MemoryVector).filter(MemoryVector.memory_id.in_([m.id for m in missing]))\
+                .delete(synchronize_session=False)
+            index_memory_vectors(s, missing)
+            s.commit()
+            done += len(missing)
+
+@app.cli.command("reindex-memory-vectors")
+def reindex_memory_vectors_cmd():
+    """Embed memories missing a vector (e.g. after changing SEMANTIC_EMBEDDER): flask --app app_db reindex-memory-vectors"""
+    print(f"[SEMANTIC] indexed {reindex_memory_vectors()} memory(ies) with {getattr(EMBEDDER, 'name', None)}")
+
+# Catch up memories written before the index existed (the hashing embedder is cheap)
+if SEMANTIC_ENABLED and SEMANTIC_EMBEDDER == "hashing":
+    try:
+        reindex_memory_vectors()
+    except Exception as e:
+        print(f"[SEMANTIC] startup reindex skipped: {e}", flush=True)
+
+# insertion order, as a tie-break for rows written with second-resolution CURRENT_TIMESTAMP
+_MSG_ROWID = literal_column("transcript_messages.rowid")
+
+def history_window_query(session_db, tr_id, summary_upto=None):
+    # Tail window only: newest rows first, then flipped back into chronological order
+    q = (session_db.query(TranscriptMessage.role, TranscriptMessage.content, TranscriptMessage.created_at)
             .filter(TranscriptMessage.transcript_id == tr_id,
                     TranscriptMessage.role.in_(["user","assistant"]))
-            .order_by(TranscriptMessage.created_at.asc())
-            .all())
-    trimmed = rows[-(max_turns*2):] if max_turns else rows
-    for m in trimmed:
-        msgs.append({"role": m.role, "content": m.content})
+            .order_by(TranscriptMessage.created_at.desc(), _MSG_ROWID.desc()))
+    if summary_upto:
+        q = q.filter(TranscriptMessage.created_at > summary_upto)
+    return q
+
+def history_window(session_db, tr_id, max_turns=12, pending_user_text=None, summary_upto=None):
+    """The DB part of build_history: (tail window rows newest first, window size)."""
+    q = history_window_query(session_db, tr_id, summary_upto)
+    limit = max_turns * 2 if max_turns else None
+    if limit and pending_user_text is not None:
+        limit -= 1   # the pending turn takes one slot of the window
+    rows = q.limit(limit).all() if limit else q.all()
+    return rows, limit
+
+def build_history(session_db, tr_id, system_prompt, max_turns=12, extra_system_text=None,
+                  pending_user_text=None, token_budget=None, summary=None, summary_upto=None,
+                  window=None, turn_at=None):
+    """
+    pending_user_text: the current user turn when it is not saved yet (always included).
+    turn_at: the created_at that turn will be saved with; when not even the newest prior
+        turn fits, everything before it is due for the summary.
+    window: history_window() result fetched elsewhere (e.g. on another connection); read here if None.
+    max_turns: upper bound on the window fetched from the DB (last max_turns*2 rows).
+    token_budget: system prompt + summary + recall + history must fit; the oldest turns are dropped first.
+    summary / summary_upto: the transcript's rolling summary; turns it already covers are skipped.
+
+    Layout is ordered for provider prompt caching (longest stable prefix first):
+      [static character prompt] [rolling summary] [prior turns, append-only] [recall block] [current user turn]
+    The recall block changes every turn, so it goes next to the newest message
+    instead of right after the system prompt where it would break the cached prefix.
+
+    Turns that fall out of the window are folded into the summary in the
+    background (see schedule_summary) once there are SUMMARY_BATCH_MSGS of them.
+    """
+    rows, limit = window or history_window(session_db, tr_id, max_turns, pending_user_text, summary_upto)
+
+    summary_msg = None
+    if summary:
+        summary_msg = {"role": "system",
+                       "content": "Summary of the earlier part of this conversation (those turns are not shown):\n" + summary}
+
+    used = count_tokens(system_prompt) + MSG_OVERHEAD_TOKENS
+    if summary_msg:
+        used += count_tokens(summary_msg["content"]) + MSG_OVERHEAD_TOKENS
+    if extra_system_text:
+        used += count_tokens(extra_system_text) + MSG_OVERHEAD_TOKENS
+    newest_first = []
+    if pending_user_text is not None:
+        newest_first.append({"role": "user", "content": pending_user_text})
+        used += count_tokens(pending_user_text) + MSG_OVERHEAD_TOKENS
+    kept = 0
+    for role, content, _created in rows:
+        cost = count_tokens(content) + MSG_OVERHEAD_TOKENS
+        if token_budget and used + cost > token_budget and newest_first:
+            break
+        newest_first.append({"role": role, "content": content})
+        used += cost
+        kept += 1
+
+    # Something older than the window is not summarised yet → maybe fold it
+    if kept < len(rows) or (limit and len(rows) == limit):
+        oldest_kept = rows[kept - 1].created_at if kept else turn_at
+        if oldest_kept is not None:
+            maybe_schedule_summary(session_db, tr_id, summary_upto, oldest_kept)
+
+    msgs = [{"role": "system", "content": system_prompt}]
+    if summary_msg:
+        msgs.append(summary_msg)
+    msgs.extend(reversed(newest_first))
+    if extra_system_text:
+        recall = {"role": "system", "content": extra_system_text}
+        if len(msgs) > 1 and msgs[-1]["role"] == "user":
+            msgs.insert(len(msgs) - 1, recall)
+        else:
+            msgs.append(recall)
     return msgs
 
+# -------------------------------
+# Rolling transcript summary (background, batched)
+# -------------------------------
+import queue
+
+SUMMARY_ENABLED     = os.getenv("SUMMARY_ENABLED", "true").lower() in ("1","true","yes")
+SUMMARY_MODEL       = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+SUMMARY_BATCH_MSGS  = int(os.getenv("SUMMARY_BATCH_MSGS", "8"))     # fold once this many turns fell out
+SUMMARY_FOLD_MAX_MSGS = int(os.getenv("SUMMARY_FOLD_MAX_MSGS", "40"))  # per model call
+SUMMARY_MAX_TOKENS  = int(os.getenv("SUMMARY_MAX_TOKENS", "400"))
+
+SUMMARY_SYSTEM = (
+    "You maintain a running summary of a long conversation between a user and a character.\n"
+    "Update the summary with the new turns. Keep names, relationships, feelings, commitments, "
+    "open questions and anything the character promised to return to. Drop small talk.\n"
+    f"Write plain prose in the third person, at most {SUMMARY_MAX_TOKENS // 2} words. Return only the summary."
+)
+
+_summary_q = queue.Queue()
+_summary_pending = set()        # transcript ids queued in this process
+_summary_lock = threading.Lock()
+_summary_thread = None
+
+def maybe_schedule_summary(s, tr_id, summary_upto, oldest_kept):
+    """Queue a fold when at least SUMMARY_BATCH_MSGS unsummarised turns are older than the window."""
+    if not SUMMARY_ENABLED:
+        return
+    q = (s.query(func.count(TranscriptMessage.id))
+            .filter(TranscriptMessage.transcript_id == tr_id,
+                    TranscriptMessage.role.in_(["user","assistant"]),
+                    TranscriptMessage.created_at < oldest_kept))
+    if summary_upto:
+        q = q.filter(TranscriptMessage.created_at > summary_upto)
+    if q.scalar() >= SUMMARY_BATCH_MSGS:
+        schedule_summary(tr_id, oldest_kept)
+
+def schedule_summary(tr_id, upto):
+    global _summary_thread
+    with _summary_lock:
+        if tr_id in _summary_pending:
+            return
+        _summary_pending.add(tr_id)
+        if _summary_thread is None or not _summary_thread.is_alive():
+            _summary_thread = threading.Thread(target=_summary_worker, name="summary", daemon=True)
+            _summary_thread.start()
+    _summary_q.put((tr_id, upto))
+
+def _summary_worker():
+    while True:
+        tr_id, upto = _summary_q.get()
+        try:
+            more = fold_summary(tr_id, upto)
+        except Exception:
+            app.logger.exception("[SUMMARY] fold failed for %s", tr_id)
+            more = False
+        with _summary_lock:
+            _summary_pending.discard(tr_id)
+        if more:
+            schedule_summary(tr_id, upto)
+
+def fold_summary(tr_id, upto):
+    """
+    Fold turns in (summary_upto, upto) into transcripts.summary, oldest first,
+    at most SUMMARY_FOLD_MAX_MSGS per call. Returns True if more remain.
+    The write is conditional on summary_upto being unchanged, so two workers
+    (e.g. two gunicorn processes) folding the same transcript can't interleave.
+    """
+    with db() as s:
+        tr = s.query(Transcript).get(tr_id)
+        if not tr:
+            return False
+        prev, since = tr.summary, tr.summary_upto
+        q = (s.query(TranscriptMessage.role, TranscriptMessage.content, TranscriptMessage.created_at)
+                .filter(TranscriptMessage.transcript_id == tr_id,
+                        TranscriptMessage.role.in_(["user","assistant"]),
+                        TranscriptMessage.created_at < upto))
+        if since:
+            q = q.filter(TranscriptMessage.created_at > since)
+        rows = q.order_by(TranscriptMessage.created_at.asc(), _MSG_ROWID.asc()).limit(SUMMARY_FOLD_MAX_MSGS).all()
+    if not rows:
+        return False
+
+    turns = "\n\n".join(f"{'User' if r.role == 'user' else 'Character'}: {r.content.strip()}" for r in rows)
+    resp = client.chat.completions.create(
+        model=SUMMARY_MODEL,
+        messages=[
+            {"role": "system", "content": SUMMARY_SYSTEM},
+            {"role": "user", "content": f"Summary so far:\n{prev or '(none yet)'}\n\nNew turns:\n{turns}"}
+        ],
+        temperature=0.2,
+        max_tokens=SUMMARY_MAX_TOKENS
+    )
+    new_summary = (resp.choices[0].message.content or "").strip()
+    usage = resp.usage
+
+    with db() as s:
+        cond = Transcript.summary_upto == since if since else Transcript.summary_upto.is_(None)
+        n = s.query(Transcript).filter(Transcript.id == tr_id, cond).update(
+            {Transcript.summary: new_summary, Transcript.summary_upto: rows[-1].created_at},
+            synchronize_session=False)
+        if n:
+            # summariser tokens count towards the user's usage, like /api/end's: ledger and a
+            # system-ui row carrying the usage, so the usage_daily rollup sees them too
+            bump_totals(s, tr_id, usage.prompt_tokens, usage.completion_tokens, usage.total_tokens, commit=False)
+            save_msg(s, tr_id, "system-ui", "Earlier turns summarised.",
+                     uin=usage.prompt_tokens, uout=usage.completion_tokens, utot=usage.total_tokens,
+                     commit=False, ucached=cached_tokens(usage))
+        s.commit()
+    return bool(n) and len(rows) == SUMMARY_FOLD_MAX_MSGS
+
 # -------------------------------
 # Chat with memory + warn/cap + history + recall
 # -------------------------------
 MONTHLY_WARN_TOKENS = int(os.getenv("MONTHLY_WARN_TOKENS", "200000"))
 MONTHLY_CAP_TOKENS  = int(os.getenv("MONTHLY_CAP_TOKENS", "300000"))
-HISTORY_TURNS       = int(os.getenv("HISTORY_TURNS", "12"))   # last N user/assistant pairs
+HISTORY_TURNS       = int(os.getenv("HISTORY_TURNS", "12"))   # at most the last N user/assistant pairs...
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "8000"))  # ...and system + recall + history under this
 RECALL_LOOKBACK_DAYS = int(os.getenv("RECALL_LOOKBACK_DAYS", "180"))
 RECALL_MAX_SNIPPETS  = int(os.getenv("RECALL_MAX_SNIPPETS", "3"))
 FEEDBACK_URL          =  os.getenv("FEEDBACK_URL", "https://qr1.be/ZU3E")
 
 
+# -------------------------------
+# Expiry sweeper: expired sessions, then guests nobody can come back as
+# -------------------------------
+# Deletes go in batches of SWEEP_BATCH_ROWS, one short transaction each, with a pause
+# in between so request writers get the lock; nothing holds it for a whole sweep.
+from sqlalchemy import select, delete, exists
+
+SWEEP_ENABLED        = os.getenv("SWEEP_ENABLED", "true").lower() in ("1","true","yes")   # with db maintenance
+SWEEP_BATCH_ROWS     = int(os.getenv("SWEEP_BATCH_ROWS", "500"))
+SWEEP_PAUSE_MS       = float(os.getenv("SWEEP_PAUSE_MS", "20"))
+GUEST_MIN_AGE_DAYS   = int(os.getenv("GUEST_MIN_AGE_DAYS", os.getenv("GUEST_SESSION_DAYS", "7")))
+
+def _sweep_batches(make_stmt, stats):
+    """Run a bounded DELETE until it removes nothing; returns rows deleted."""
+    total = 0
+    while True:
+        t = time.perf_counter()
+        with engine.begin() as conn:
+            n = conn.execute(make_stmt()).rowcount
+        stats["batches"] += 1
+        stats["max_batch_ms"] = max(stats["max_batch_ms"], round((time.perf_counter() - t) * 1000, 1))
+        total += n
+        if n < SWEEP_BATCH_ROWS:
+            return total
+        time.sleep(SWEEP_PAUSE_MS / 1000.0)
+
+def sweep_expired(now=None):
+    """Delete expired sessions, then old guest users with no transcripts and no session left."""
+    now = now or dt.datetime.utcnow()
+    stats = {"sessions": 0, "guests": 0, "batches": 0, "max_batch_ms": 0.0}
+
+    expired = select(WebSession.id).where(WebSession.expires_at < now).limit(SWEEP_BATCH_ROWS)
+    stats["sessions"] = _sweep_batches(
+        lambda: delete(WebSession).where(WebSession.id.in_(expired)), stats)
+
+    # a guest with a transcript has history worth keeping (and may still sign in to claim it)
+    orphans = (select(User.id)
+               .where(User.email.is_(None),
+                      User.created_at < now - dt.timedelta(days=GUEST_MIN_AGE_DAYS),
+                      ~exists().where(Transcript.user_id == User.id),
+                      ~exists().where(WebSession.user_id == User.id),
+                      ~exists().where(UserProfile.user_id == User.id))
+               .limit(SWEEP_BATCH_ROWS))
+    stats["guests"] = _sweep_batches(
+        lambda: delete(User).where(User.id.in_(orphans)), stats)
+    return stats
+
+
+@app.cli.command("sweep-expired")
+def sweep_expired_cmd():
+    """Delete expired sessions and orphaned guests: flask --app app_db sweep-expired"""
+    print(f"[SWEEP] {sweep_expired()}")
+
+
+# -------------------------------
+# Daily usage rollup: usage_daily, fed incrementally from transcript_messages
+# -------------------------------
+# Messages are append-only, so a (created_at, id) watermark marks what has been rolled up
+# (not the rowid: SQLite hands out max(rowid)+1 again once the newest rows are deleted).
+# Rows younger than ROLLUP_LAG_SECS are left for the next pass, so a turn committed a
+# moment after a later-stamped one from another worker is still picked up in order.
+# Each batch moves the watermark (compare-and-set, first, so it takes the write lock)
+# and adds the batch's sums in the same transaction: a row is never counted twice.
+# Archival rolls up first and then moves only rows at or below the watermark, so history
+# in usage_daily survives it (rebuild_usage_daily adds the archives back in from scratch).
+ROLLUP_ENABLED       = os.getenv("ROLLUP_ENABLED", "true").lower() in ("1","true","yes")
+ROLLUP_INTERVAL_SECS = int(os.getenv("ROLLUP_INTERVAL_SECS", "60"))
+ROLLUP_BATCH_ROWS    = int(os.getenv("ROLLUP_BATCH_ROWS", "20000"))
+ROLLUP_LAG_SECS      = int(os.getenv("ROLLUP_LAG_SECS", "30"))
+_ROLLUP = "usage_daily"
+
+# created_at is compared as stored (SQLAlchemy's "YYYY-MM-DD HH:MM:SS.ffffff" text)
+_ROLLUP_BATCH_END = text("""
+    SELECT created_at, id, COUNT(*) OVER () FROM (
+        SELECT created_at, id FROM transcript_messages
+        WHERE (created_at, id) > (:lo_at, :lo_id) AND created_at < :cutoff
+        ORDER BY created_at, id LIMIT :n)
+    ORDER BY created_at DESC, id DESC LIMIT 1
+""")
+
+_ROLLUP_UPSERT = text("""
+    INSERT INTO usage_daily (day, user_id, character, token_input, token_output, token_total, message_count)
+    SELECT substr(m.created_at, 1, 10), t.user_id, t.character,
+           COALESCE(SUM(m.usage_input), 0), COALESCE(SUM(m.usage_output), 0), COALESCE(SUM(m.usage_total), 0),
+           SUM(m.role IN ('user', 'assistant'))
+    FROM transcript_messages m JOIN transcripts t ON t.id = m.transcript_id
+    WHERE (m.created_at, m.id) > (:lo_at, :lo_id) AND (m.created_at, m.id) <= (:hi_at, :hi_id)
+    GROUP BY 1, 2, 3
+    ON CONFLICT (day, user_id, character) DO UPDATE SET
+        token_input   = token_input   + excluded.token_input,
+        token_output  = token_output  + excluded.token_output,
+        token_total   = token_total   + excluded.token_total,
+        message_count = message_count + excluded.message_count
+""")
+
+def _rollup_watermark(conn):
+    """(last_created_at, last_id), or None when there is no watermark yet (fresh DB, or reset by migration 8)."""
+    return conn.execute(text("SELECT last_created_at, last_id FROM rollup_watermarks WHERE name = :n"),
+                        {"n": _ROLLUP}).first()
+
+def rollup_usage_daily():
+    """Roll up everything past the watermark, ROLLUP_BATCH_ROWS messages per transaction. Returns rows consumed."""
+    with engine.connect() as conn:
+        if _rollup_watermark(conn) is None:
+            return rebuild_usage_daily()
+    done = 0
+    while True:
+        cutoff = (dt.datetime.utcnow() - dt.timedelta(seconds=ROLLUP_LAG_SECS)).strftime("%Y-%m-%d %H:%M:%S.%f")
+        with engine.begin() as conn:
+            lo = _rollup_watermark(conn)
+            if lo is None:
+                return done   # a rebuild reset it under us; that one carries on
+            lo_at, lo_id = lo
+            hi = conn.execute(_ROLLUP_BATCH_END, {"lo_at": lo_at, "lo_id": lo_id, "cutoff": cutoff,
+                                                  "n": ROLLUP_BATCH_ROWS}).first()
+            if hi is None:
+                return done
+            hi_at, hi_id, batch = hi
+            moved = conn.execute(text("""
+                UPDATE rollup_watermarks SET last_created_at = :hi_at, last_id = :hi_id, updated_at = :now
+                WHERE name = :n AND last_created_at = :lo_at AND last_id = :lo_id"""),
+                {"hi_at": hi_at, "hi_id": hi_id, "lo_at": lo_at, "lo_id": lo_id,
+                 "n": _ROLLUP, "now": dt.datetime.utcnow()}).rowcount
+            if not moved:
+                return done   # another process took this batch
+            conn.execute(_ROLLUP_UPSERT, {"lo_at": lo_at, "lo_id": lo_id, "hi_at": hi_at, "hi_id": hi_id})
+        done += batch
+
+def rebuild_usage_daily():
+    """Recompute usage_daily from the hot table + archives and reset the watermark."""
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM usage_daily"))
+        conn.execute(text("DELETE FROM rollup_watermarks WHERE name = :n"), {"n": _ROLLUP})
+        conn.execute(text("""INSERT INTO rollup_watermarks (name, last_created_at, last_id, updated_at)
+                             VALUES (:n, '', '', :now)"""), {"n": _ROLLUP, "now": dt.datetime.utcnow()})
+        s = Session(bind=conn)
+        characters = dict(s.query(Transcript.id, Transcript.character).filter(Transcript.archived_at.isnot(None)))
+        sums = {}
+        for arc_user, _mk, blob in s.query(TranscriptArchive.user_id, TranscriptArchive.month_key,
+                                           TranscriptArchive.blob):
+            for d in _unpack_messages(blob):
+                key = (d["created_at"].strftime("%Y-%m-%d"), arc_user, characters.get(d["transcript_id"], "?"))
+                acc = sums.setdefault(key, [0, 0, 0, 0])
+                acc[0] += d["usage_input"] or 0; acc[1] += d["usage_output"] or 0; acc[2] += d["usage_total"] or 0
+                acc[3] += d["role"] in ("user", "assistant")
+        for (day, uid, ch), (uin, uout, utot, n) in sums.items():
+            conn.execute(text("""INSERT INTO usage_daily VALUES (:d, :u, :c, :i, :o, :t, :n)"""),
+                         {"d": day, "u": uid, "c": ch, "i": uin, "o": uout, "t": utot, "n": n})
+    return rollup_usage_daily()
+
+if ROLLUP_ENABLED and ROLLUP_INTERVAL_SECS > 0:
+    # one process per host runs it (see owner_loop); the CAS keeps a CLI run from double counting
+    threading.Thread(target=owner_loop, args=("rollup", ROLLUP_INTERVAL_SECS, rollup_usage_daily, "ROLLUP"),
+                     name="usage-rollup", daemon=True).start()
+
+
+@app.cli.command("rollup-usage")
+@click.option("--rebuild", is_flag=True, help="Recompute from scratch (hot messages + archives).")
+def rollup_usage_cmd(rebuild):
+    """Bring usage_daily up to date: flask --app app_db rollup-usage [--rebuild]"""
+    n = rebuild_usage_daily() if rebuild else rollup_usage_daily()
+    print(f"[ROLLUP] consumed {n} message(s)")
+
+
+# -------------------------------
+# Cold-month archival: messages of old months -> one compressed blob per user+month
+# -------------------------------
+# The chat path reads only the current month and recall looks back RECALL_LOOKBACK_DAYS,
+# so whole months older than ARCHIVE_AFTER_DAYS leave the hot table (and its FTS index).
+# Transcript rows stay (usage, titles); exports read archived messages transparently.
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", str(RECALL_LOOKBACK_DAYS + 31)))
+ARCHIVE_AUTO = os.getenv("ARCHIVE_AUTO", "false").lower() in ("1","true","yes")   # run with db maintenance
+
+_ARCHIVE_FIELDS = ["id", "transcript_id", "role", "content", "created_at",
+                   "usage_input", "usage_output", "usage_total", "usage_cached"]
+
+def _pack_messages(rows):
+    lines = [json.dumps({k: (v.isoformat() if isinstance(v, dt.datetime) else v) for k, v in zip(_ARCHIVE_FIELDS, r)},
+                        ensure_ascii=False) for r in rows]
+    raw = ("\n".join(lines) + "\n").encode("utf-8") if lines else b""
+    return zlib.compress(raw, 9), len(raw)
+
+def _unpack_messages(blob):
+    out = []
+    for line in zlib.decompress(blob).decode("utf-8").splitlines():
+        if line:
+            d = json.loads(line)
+            d["created_at"] = dt.datetime.fromisoformat(d["created_at"]) if d.get("created_at") else None
+            out.append(d)
+    return out
+
+def _store_archive(s, user_id, mk, rows):
+    """Write rows (_ARCHIVE_FIELDS tuples) to user_id's archive for mk, merged into any blob already there."""
+    arc = s.get(TranscriptArchive, (user_id, mk))
+    # late rows for an already archived month are merged into the same blob
+    old = [tuple(d[f] for f in _ARCHIVE_FIELDS) for d in _unpack_messages(arc.blob)] if arc else []
+    merged = sorted(old + [tuple(r) for r in rows], key=lambda r: (r[1], r[4] or dt.datetime.min))
+    blob, raw_bytes = _pack_messages(merged)
+    if arc is None:
+        arc = TranscriptArchive(user_id=user_id, month_key=mk)
+        s.add(arc)
+    arc.blob, arc.raw_bytes, arc.message_count = blob, raw_bytes, len(merged)
+    arc.archived_at = dt.datetime.utcnow()
+    return arc
+
+def archive_cutoff_month(now=None):
+    """Months strictly before this month_key are cold."""
+    return month_key_utc((now or dt.datetime.utcnow()) - dt.timedelta(days=ARCHIVE_AFTER_DAYS))
+
+def archive_user_month(user_id, mk):
+    """Move one user's messages for month mk into transcript_archives (one transaction). Returns the count."""
+    with db() as s:
+        # only rows the usage rollup has counted: usage_daily must not lose them
+        mark = _rollup_watermark(s.connection())
+        if mark is None:
+            return 0
+        tr_ids = [t for (t,) in s.query(Transcript.id).filter(Transcript.user_id == user_id,
+                                                               Transcript.month_key == mk)]
+        rows = (s.query(*[getattr(TranscriptMessage, f) for f in _ARCHIVE_FIELDS])
+                  .filter(TranscriptMessage.transcript_id.in_(tr_ids),
+                          tuple_(type_coerce(TranscriptMessage.created_at, String),   # as stored, like the rollup
+                                 TranscriptMessage.id) <= tuple_(*mark))
+                  .order_by(TranscriptMessage.transcript_id, TranscriptMessage.created_at, _MSG_ROWID)
+                  .all()) if tr_ids else []
+        if not rows:
+            return 0
+        arc = _store_archive(s, user_id, mk, rows)
+        # FTS delete triggers keep the recall index in step
+        s.query(TranscriptMessage).filter(TranscriptMessage.id.in_([r[0] for r in rows]))\
+            .delete(synchronize_session=False)
+        s.query(Transcript).filter(Transcript.id.in_(tr_ids))\
+            .update({Transcript.archived_at: arc.archived_at}, synchronize_session=False)
+        s.commit()
+    invalidate_recall(user_id, kind="msg")
+    return len(rows)
+
+def archive_cold_months(before_month=None):
+    """Archive every user+month older than before_month (default: archive_cutoff_month()). Returns (groups, messages)."""
+    before_month = before_month or archive_cutoff_month()
+    rollup_usage_daily()   # bring the watermark up first (archive_user_month stops at it)
+    with db() as s:
+        pairs = (s.query(Transcript.user_id, Transcript.month_key)
+                   .filter(Transcript.month_key < before_month,
+                           s.query(TranscriptMessage.id)
+                            .filter(TranscriptMessage.transcript_id == Transcript.id).exists())
+                   .distinct().all())
+    moved = 0
+    for user_id, mk in pairs:
+        moved += archive_user_month(user_id, mk)
+    return len(pairs), moved
+
+def archived_messages(s, tr):
+    """Archived messages of one transcript (dicts with the TranscriptMessage fields), oldest first."""
+    if tr is None or not tr.archived_at:
+        return []
+    arc = s.get(TranscriptArchive, (tr.user_id, tr.month_key))
+    if arc is None:
+        return []
+    return [d for d in _unpack_messages(arc.blob) if d["transcript_id"] == tr.id]
+
+
+@app.cli.command("archive-cold-months")
+@click.option("--before", "before_month", default=None, help="YYYY-MM; default: ARCHIVE_AFTER_DAYS ago.")
+def archive_cold_months_cmd(before_month):
+    """Move cold months' messages into compressed archives: flask --app app_db archive-cold-months"""
+    groups, moved = archive_cold_months(before_month)
+    print(f"[ARCHIVE] {moved} message(s) from {groups} user-month(s) before {before_month or archive_cutoff_month()}")
+
+
 # -------------------------------
 # Pricing (per 1M tokens)
 # -------------------------------
@@ -1015,9 +3189,15 @@ TTS_RATE          = float(os.getenv("RATE_TTS", "0.6")) / 1_000_000
 STT_RATE          = float(os.getenv("RATE_STT", "2.5")) / 1_000_000
 
 
+def cached_tokens(usage):
+    """Prompt tokens the provider served from its prompt cache (0 when not reported)."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return int(getattr(details, "cached_tokens", 0) or 0)
+
 def cost_from_usage(usage):
-    # For now we assume no caching; cached tokens not exposed in usage
-    input_cost  = usage.prompt_tokens     * INPUT_RATE
+    # Cached prompt tokens are billed at CACHED_INPUT_RATE, the rest at INPUT_RATE
+    cached = min(cached_tokens(usage), usage.prompt_tokens)
+    input_cost  = (usage.prompt_tokens - cached) * INPUT_RATE + cached * CACHED_INPUT_RATE
     output_cost = usage.completion_tokens * OUTPUT_RATE
     return input_cost + output_cost
 
@@ -1028,9 +3208,50 @@ def cost_tts(tokens):
     return tokens * TTS_RATE
 
 
-@app.post("/api/ask")
-def api_ask():
-    data = request.get_json(force=True)
+# -------------------------------
+# Concurrent context assembly: recall + history reads on their own read-only connections
+# -------------------------------
+from concurrent.futures import ThreadPoolExecutor, Future
+
+CONTEXT_THREADS = int(os.getenv("CONTEXT_THREADS", "8"))   # 0 = run the reads inline, one after another
+_context_pool = ThreadPoolExecutor(max_workers=CONTEXT_THREADS, thread_name_prefix="ctx") if CONTEXT_THREADS > 0 else None
+
+def _timed(timings, stage, fn, *args, **kw):
+    t = time.perf_counter()
+    try:
+        return fn(*args, **kw)
+    finally:
+        timings[stage] = round((time.perf_counter() - t) * 1000, 1)
+
+def _on_readonly(fn, *args, **kw):
+    # WAL: readers don't block the writer or each other, so each stage gets its own connection
+    s = _readonly_session()
+    try:
+        return fn(s, *args, **kw)
+    finally:
+        s.close()
+
+def _read_stage(timings, stage, fn, *args, **kw):
+    """Start fn(readonly_session, ...) in the background; returns a Future."""
+    if _context_pool is None:
+        f = Future()
+        try:
+            f.set_result(_timed(timings, stage, _on_readonly, fn, *args, **kw))
+        except Exception as e:
+            f.set_exception(e)
+        return f
+    return _context_pool.submit(_timed, timings, stage, _on_readonly, fn, *args, **kw)
+
+
+def _ask_prepare(data):
+    """
+    Everything /api/ask does before the model call: validate input, ban + cap
+    checks, save the user turn, recall and history.
+    Recall and the history window are read concurrently with the checks, so the
+    pre-model overhead is about the slowest stage rather than the sum; per-stage
+    timings (ms) come back in ctx["stage_ms"].
+    Returns (ctx, None) on success or (None, (json_body, status)) to short-circuit.
+    """
     character = data.get("character")
     user_input = data.get("user_input")
     hold_phrase = data.get("hold_phrase", "")
@@ -1039,51 +3260,69 @@ def api_ask():
         user_input = f'(Earlier you said: "{hold_phrase}")\n\n{user_input or ""}'
 
     if not character or not user_input:
-        return jsonify({"error": "Missing character or user_input"}), 400
+        return None, ({"error": "Missing character or user_input"}, 400)
 
     system_prompt = load_prompt(character)
     if not system_prompt:
-        return jsonify({"error": f"Character '{character}' not found."}), 404
+        return None, ({"error": f"Character '{character}' not found."}, 404)
 
     uid = get_current_user_id() or ensure_guest_user()
     mk = month_key_utc()
 
-    # Hard block if previously banned
+    system_notices = []
+    timings = {}
+    t_start = time.perf_counter()
+    turn_at = dt.datetime.utcnow()   # the user turn's created_at, stamped before any history is read
+
+    # Recall only needs the user and the query: start it before anything else
+    recall_f = _read_stage(timings, "recall", retrieve_relevant_snippets,
+                           user_id=uid, character=character, user_query=user_input,
+                           lookback_days=RECALL_LOOKBACK_DAYS, max_snippets=RECALL_MAX_SNIPPETS)
+
+    # One session for checks, then a single commit for the user turn
+    # (plus the transcript row on the first turn of the month).
     with db() as s:
+        t_checks = time.perf_counter()
+        # Hard block if previously banned
         u = s.query(User).get(uid)
         if u and u.is_banned:
-            return jsonify({
+            recall_f.cancel()
+            return None, ({
                 "system_ui": "Your access has been revoked due to repeated offensive content.",
                 "capped": False,
                 "feedback_url": FEEDBACK_URL
-            }), 403
+            }, 403)
 
-    snippets = []
-    system_notices = []
+        tr = find_or_create_transcript(s, uid, character, mk, commit=False)
+        tid = tr.id
 
-    with db() as s:
-        tr = find_or_create_transcript(s, uid, character, mk)
+        # History window in the background too (a transcript created just now has none)
+        if tr in s.new:
+            history_f = Future()
+            history_f.set_result(([], None))
+        else:
+            history_f = _read_stage(timings, "history", history_window, tid, max_turns=HISTORY_TURNS,
+                                    pending_user_text=user_input, summary_upto=tr.summary_upto)
 
         # cap check BEFORE model call
         totals_pre = monthly_usage(s, uid, mk)
+        timings["checks"] = round((time.perf_counter() - t_checks) * 1000, 1)
         if totals_pre["total"] >= MONTHLY_CAP_TOKENS:
+            count_cap_hit("cap")
+            recall_f.cancel()
+            history_f.cancel()
             msg = "You’ve reached your monthly usage cap for this trial. Come back next month or contact us for more access."
-            save_msg(s, tr.id, "system-ui", msg)
-            return jsonify({
+            save_msg(s, tid, "system-ui", msg, commit=False)
+            s.commit()
+            return None, ({
                 "system_ui": msg,
                 "capped": True,
-                "transcript_id": tr.id,
-                "feedback_url": f"{FEEDBACK_URL}?tid={tr.id}"
-            }), 402
-
-        # save this user turn
-        save_msg(s, tr.id, "user", user_input)
+                "transcript_id": tid,
+                "feedback_url": f"{FEEDBACK_URL}?tid={tid}"
+            }, 402)
 
-        # retrieve relevant snippets from prior transcripts/memories
-        snippets = retrieve_relevant_snippets(
-            s, user_id=uid, character=character, user_query=user_input,
-            lookback_days=RECALL_LOOKBACK_DAYS, max_snippets=RECALL_MAX_SNIPPETS
-        )
+        # relevant snippets from prior transcripts/memories
+        snippets = recall_f.result()
         extra_system_text = None
         if snippets:
             extra_system_text = "Prior relevant excerpts from this user’s earlier conversations with you:\n\n" + \
@@ -1091,141 +3330,304 @@ def api_ask():
             system_notices.append(f"Pulled {len(snippets)} note(s) from your previous chats to help continuity.")
 
         # build full history (system + optional recall + prior turns incl. this one)
-        messages = build_history(s, tr.id, system_prompt, max_turns=HISTORY_TURNS, extra_system_text=extra_system_text)
+        messages = build_history(s, tid, system_prompt, max_turns=HISTORY_TURNS,
+                                 extra_system_text=extra_system_text, pending_user_text=user_input,
+                                 token_budget=HISTORY_TOKEN_BUDGET,
+                                 summary=tr.summary, summary_upto=tr.summary_upto,
+                                 window=history_f.result(), turn_at=turn_at)
+
+        new_tr = None
+        if tr in s.new:
+            s.expunge(tr)   # first turn of the month: the transcript row goes in with the user turn
+            new_tr = tr
+
+    # save this user turn (write-behind in async mode: later writes queue behind it)
+    def write_user_turn(w):
+        if new_tr is not None:
+            w.add(new_tr)
+        save_msg(w, tid, "user", user_input, commit=False, created_at=turn_at, turn_query=user_input)
+    _timed(timings, "write", run_write, write_user_turn, wait=False)
+
+    timings["total"] = round((time.perf_counter() - t_start) * 1000, 1)
+    observe_stage_ms(timings)
 
-    # model call (outside DB session)
+    return {
+        "uid": uid,
+        "character": character,
+        "mk": mk,
+        "tid": tid,
+        "user_input": user_input,
+        "messages": messages,
+        "system_notices": system_notices,
+        "stage_ms": timings,
+    }, None
+
+
+
+def _ask_failed(ctx, e):
+    """Record a model-call failure in the transcript (best effort)."""
+    run_write(lambda s: save_msg(s, ctx["tid"], "system-ui", f"Server error: {str(e)}", commit=False),
+              wait=False)
+
+
+def _ask_abandoned(ctx, partial, usage=None):
+    """
+    The client went away mid-stream: the tokens spent so far still count against the cap.
+    Saves the partial reply through _ask_finish; usage is the stream's own when it got that
+    far, otherwise estimated (prompt as sent + partial reply, counted with count_tokens).
+    """
+    if usage is None:
+        prompt = sum(count_tokens(m["content"]) + MSG_OVERHEAD_TOKENS for m in ctx["messages"])
+        completion = count_tokens(partial)
+        usage = SimpleNamespace(prompt_tokens=prompt, completion_tokens=completion,
+                                total_tokens=prompt + completion, prompt_tokens_details=None)
+    partial = partial.strip()
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.8
-        )
-        message = response.choices[0].message.content.strip()
-        usage = response.usage
-        cost_estimate = cost_from_usage(usage)
-    except Exception as e:
-        with db() as s:
-            tr = find_or_create_transcript(s, uid, character, mk)
-            save_msg(s, tr.id, "system-ui", f"Server error: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        if partial:
+            _ask_finish(ctx, partial, usage)
+            return
+        # nothing to show for it: charge the prompt on a system-ui row (like /api/end's)
+        def tx(s):
+            bump_totals(s, ctx["tid"], usage.prompt_tokens, usage.completion_tokens, usage.total_tokens, commit=False)
+            save_msg(s, ctx["tid"], "system-ui", "Reply interrupted: the client disconnected.",
+                     uin=usage.prompt_tokens, uout=usage.completion_tokens, utot=usage.total_tokens,
+                     commit=False, ucached=cached_tokens(usage))
+        run_write(tx)
+        count_usage(usage)
+    except Exception:
+        app.logger.exception("[ASK] could not record an abandoned stream for %s", ctx["tid"])
 
-    # persist assistant turn + usage; warn banner if crossing X
-    warn_banner = None
-    moderation_banner = None  # <- collect any moderation text for the UI
 
-    with db() as s:
-        tr = find_or_create_transcript(s, uid, character, mk)
+def _ask_finish(ctx, message, usage):
+    """
+    Everything /api/ask does after the model call: persist the assistant turn,
+    bump usage, act on the moderation tag and the warn threshold.
+    Returns the metadata part of the response (everything except the reply).
+    """
+    uid, mk, tid = ctx["uid"], ctx["mk"], ctx["tid"]
+    system_notices = ctx["system_notices"]
+    cost_estimate = cost_from_usage(usage)
+    t_persist = time.perf_counter()
 
-        # BEFORE bumping totals, capture the pre-usage total for the threshold check
-        totals_pre = monthly_usage(s, uid, mk)
+    # Persist assistant turn + usage; warn banner if crossing X; collect any moderation
+    # text for the UI. One write transaction for the whole post-call phase. Writes go first
+    # so the transaction starts as a writer (no read→write upgrade that can hit SQLITE_BUSY).
+    tag, fixed_ok = parse_moderation_tag(message)
+
+    def tx(s):
+        moderation_banner = warn_banner = None
+        bump_totals(s, tid, usage.prompt_tokens, usage.completion_tokens, usage.total_tokens, commit=False)
 
         # Save assistant message + usage
         save_msg(
-            s, tr.id, "assistant", message,
-            uin=usage.prompt_tokens, uout=usage.completion_tokens, utot=usage.total_tokens
+            s, tid, "assistant", message,
+            uin=usage.prompt_tokens, uout=usage.completion_tokens, utot=usage.total_tokens,
+            commit=False, ucached=cached_tokens(usage), turn_query=ctx["user_input"]
         )
-        bump_totals(s, tr.id, usage.prompt_tokens, usage.completion_tokens, usage.total_tokens)
 
         # --- Moderation tag handling (from character's reply) ---
-        tag, fixed_ok = parse_moderation_tag(message)
         if tag:
-            u = s.query(User).get(uid)
-
             if tag == "ABUSE_WARN":
                 # Agency-led: only act when the character chooses to tag
-                if u:
-                    u.abuse_count = int(u.abuse_count or 0) + 1
-                    s.commit()
+                s.query(User).filter(User.id == uid).update(
+                    {User.abuse_count: func.coalesce(User.abuse_count, 0) + 1},
+                    synchronize_session=False)
                 moderation_banner = "⚠️ Please choose respect. Continued disrespect may end this access."
-                save_msg(s, tr.id, "system-ui", moderation_banner)
 
             elif tag == "ABUSE_BAN":
-                if u:
-                    u.abuse_count = int(u.abuse_count or 0) + 1
-                    u.is_banned = True
-                    s.commit()
+                s.query(User).filter(User.id == uid).update(
+                    {User.abuse_count: func.coalesce(User.abuse_count, 0) + 1, User.is_banned: True},
+                    synchronize_session=False)
                 moderation_banner = "Access revoked due to repeated offensive content."
-                save_msg(s, tr.id, "system-ui", moderation_banner)
 
             elif tag == "SELF_HARM_URGENT":
                 # Mandatory by contract; banner text is user-facing
                 moderation_banner = "URGENT: If you are in immediate danger, contact local emergency services now."
-                save_msg(s, tr.id, "system-ui", moderation_banner)
                 # Optional: session hold for safety (enable if you want)
                 # session["hold_for_safety"] = True
 
             elif tag == "SELF_HARM_SUPPORT":
                 moderation_banner = "Support: Please seek help beyond this chat—someone you trust or a trained helper."
-                save_msg(s, tr.id, "system-ui", moderation_banner)
 
             elif tag == "LEGAL_DISCLOSURE":
                 moderation_banner = "Legal disclosure: Confessions of harm cannot be held in confidence."
-                save_msg(s, tr.id, "system-ui", moderation_banner)
 
-        # --- Monthly usage warn (unchanged logic) ---
+            if moderation_banner:
+                save_msg(s, tid, "system-ui", moderation_banner, commit=False)
 
+        # --- Monthly usage warn (unchanged logic) ---
+        # Read after our own bump (inside the same transaction); pre = after - this turn.
+        s.flush()
         totals_after = monthly_usage(s, uid, mk)
-        tp = (totals_pre or {}).get("total", 0)
         ta = (totals_after or {}).get("total", 0)
+        tp = ta - int(usage.total_tokens or 0)
         if tp < MONTHLY_WARN_TOKENS <= ta:
             warn_banner = "Heads-up: you’ve reached your monthly trial usage threshold. You can continue for now, but heavy use may pause until the next cycle."
-            save_msg(s, tr.id, "system-ui", warn_banner)
+            save_msg(s, tid, "system-ui", warn_banner, commit=False)
+        return moderation_banner, warn_banner, totals_after
 
-        tid = tr.id 
-        feedback_url = f"{FEEDBACK_URL}?tid={tr.id}"
+    moderation_banner, warn_banner, totals_after = run_write(tx)
+    # counted after the write: in group mode a failed batch replays tx
+    count_usage(usage)
+    if tag:
+        count_moderation_tag(tag)
+    if warn_banner:
+        count_cap_hit("warn")
+    observe_stage("persist", time.perf_counter() - t_persist)
 
-
-    # combine recall + warn into one banner text for UI
-    system_ui_combined = None
-    if system_notices:
-        system_ui_combined = " ".join(system_notices + ([warn_banner] if warn_banner else []))
-    else:
-        system_ui_combined = warn_banner
+    feedback_url = f"{FEEDBACK_URL}?tid={tid}"
 
     # Combine recall + moderation + usage-warn into one UI banner
     parts = []
     if system_notices:  # e.g., recall messages you already collect
         parts.append(" ".join(system_notices))
-    if moderation_banner:  # from Step 5
-       parts.append(moderation_banner)
-    if warn_banner:        # from Step 5
+    if moderation_banner:
+        parts.append(moderation_banner)
+    if warn_banner:
         parts.append(warn_banner)
 
     system_ui_combined = " ".join([p for p in parts if p]) or None
 
-    return jsonify({
-                    "reply": message,
-                    "prompt_tokens": usage.prompt_tokens,
-                    "completion_tokens": usage.completion_tokens,
-                    "total_tokens": usage.total_tokens,
-                    "estimated_cost": round(cost_estimate, 5),
-                    "system_ui": system_ui_combined,
-                   "capped": False,
-                    "transcript_id": tid,
-                    "feedback_url": feedback_url,
-                    # NEW
-                    "cumulative_tokens": totals_after["total"],
-                    "cap_tokens": MONTHLY_CAP_TOKENS
-          })
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "total_tokens": usage.total_tokens,
+        "cached_tokens": cached_tokens(usage),
+        "estimated_cost": round(cost_estimate, 5),
+        "system_ui": system_ui_combined,
+        "capped": False,
+        "transcript_id": tid,
+        "feedback_url": feedback_url,
+        "cumulative_tokens": totals_after["total"],
+        "cap_tokens": MONTHLY_CAP_TOKENS,
+        "stage_ms": ctx.get("stage_ms"),
+    }
+
+
+@app.post("/api/ask")
+def api_ask():
+    data = request.get_json(force=True)
+    ctx, early = _ask_prepare(data)
+    if early:
+        body, status = early
+        return jsonify(body), status
+
+    # model call (outside DB session)
+    try:
+        with model_call("llm"):
+            response = client.chat.completions.create(
+                model="gpt-4o",
+                messages=ctx["messages"],
+                temperature=0.8
+            )
+        message = response.choices[0].message.content.strip()
+        usage = response.usage
+    except Exception as e:
+        _ask_failed(ctx, e)
+        return jsonify({"error": str(e)}), 500
+
+    meta = _ask_finish(ctx, message, usage)
+    return jsonify({"reply": message, **meta})
+
+
+def _sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.post("/api/ask/stream")
+def api_ask_stream():
+    """
+    Same contract as /api/ask, but the reply is sent as Server-Sent Events:
+      event: delta  data: {"text": "..."}      (repeated, as tokens arrive)
+      event: done   data: {"reply": ..., <same metadata as /api/ask>}
+      event: error  data: {"error": "..."}
+    Early exits (400/402/403/404) are plain JSON, exactly like /api/ask.
+    """
+    data = request.get_json(force=True)
+    ctx, early = _ask_prepare(data)
+    if early:
+        body, status = early
+        return jsonify(body), status
+
+    def gen():
+        parts = []
+        usage = stream = None
+        try:
+            with model_call("llm"):   # until the last chunk
+                stream = client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=ctx["messages"],
+                    temperature=0.8,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+                for chunk in stream:
+                    if chunk.usage:
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        yield _sse("delta", {"text": delta})
+            if usage is None:
+                raise RuntimeError("stream ended without usage")
+        except GeneratorExit:
+            # client disconnected (the server closes us at a yield): stop the upstream call,
+            # then save what was said and charge for it, or dropping the connection dodges the cap
+            if stream is not None:
+                stream.close()
+            _ask_abandoned(ctx, "".join(parts), usage)
+            raise
+        except Exception as e:
+            _ask_failed(ctx, e)
+            yield _sse("error", {"error": str(e)})
+            return
+
+        message = "".join(parts).strip()
+        meta = _ask_finish(ctx, message, usage)
+        yield _sse("done", {"reply": message, **meta})
+
+    resp = Response(gen(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"   # don't let a proxy buffer the stream
+    return resp
 
 
 # -------------------------------
 # End-of-session: summarise to profile + memories
 # -------------------------------
-@app.post("/api/end")
-def end_session():
-    data = request.get_json(force=True)
+CURATOR_SYSTEM = (
+    "You are a post-conversation curator for a character.\n"
+    "Given the conversation, return JSON with fields:\n"
+    "{"
+    "  \"profile_updates\": {"
+    "    \"display_name\": string|optional,"
+    "    \"relationships\": array of {\"name\": string, \"relation\": string}|optional,"
+    "    \"preferences\": array of string|optional,"
+    "    \"key_events\": array of {\"label\": string, \"date\": string (ISO or natural), \"notes\": string}|optional"
+    "  },"
+    "  \"memories\": ["
+    "     {\"kind\": \"fact|preference|event|insight|followup\","
+    "      \"title\": string, \"content\": string, \"tags\": [string],"
+    "      \"importance\": 1-5, \"follow_up_after\": string|optional}"
+    "  ]"
+    "}\n"
+    "Only include items you are confident about. Be concise; do not invent details."
+)
+
+def _end_prepare(data):
+    """Validate an /api/end payload and collect the compact transcript text. Returns (ctx, None) or (None, (body, status))."""
     character = data.get("character")
     tid = data.get("transcript_id")
     if not character or not tid:
-        return jsonify({"ok": False, "error": "Missing character or transcript_id"}), 400
+        return None, ({"ok": False, "error": "Missing character or transcript_id"}, 400)
 
     uid = get_current_user_id() or ensure_guest_user()
     # collect compact transcript text
     with db() as s:
         tr = s.query(Transcript).get(tid)
         if not tr or tr.user_id != uid or tr.character != character:
-            return jsonify({"ok": False, "error": "Transcript not found"}), 404
+            return None, ({"ok": False, "error": "Transcript not found"}, 404)
         msgs = (s.query(TranscriptMessage)
                   .filter(TranscriptMessage.transcript_id == tid,
                           TranscriptMessage.role.in_(["user","assistant"]))
@@ -1236,71 +3638,78 @@ def end_session():
             convo.append(f"{role}: {m.content.strip()}")
         convo_text = "\n\n".join(convo)[-12000:]  # keep compact
 
-    system = (
-        "You are a post-conversation curator for a character.\n"
-        "Given the conversation, return JSON with fields:\n"
-        "{"
-        "  \"profile_updates\": {"
-        "    \"display_name\": string|optional,"
-        "    \"relationships\": array of {\"name\": string, \"relation\": string}|optional,"
-        "    \"preferences\": array of string|optional,"
-        "    \"key_events\": array of {\"label\": string, \"date\": string (ISO or natural), \"notes\": string}|optional"
-        "  },"
-        "  \"memories\": ["
-        "     {\"kind\": \"fact|preference|event|insight|followup\","
-        "      \"title\": string, \"content\": string, \"tags\": [string],"
-        "      \"importance\": 1-5, \"follow_up_after\": string|optional}"
-        "  ]"
-        "}\n"
-        "Only include items you are confident about. Be concise; do not invent details."
-    )
-
-    try:
-        resp = client.chat.completions.create(
-            model="gpt-4o",
-            response_format={"type": "json_object"},
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": f"Character: {character}\n\nConversation:\n{convo_text}"}
-            ],
-            temperature=0.2
-        )
-        usage = resp.usage
-        payload = json.loads(resp.choices[0].message.content)
-    except Exception as e:
-        with db() as s:
-            save_msg(s, tid, "system-ui", f"Summary failed: {str(e)}")
-        return jsonify({"ok": False, "error": str(e)}), 500
-
+    return {
+        "uid": uid,
+        "character": character,
+        "tid": tid,
+        "messages": [
+            {"role": "system", "content": CURATOR_SYSTEM},
+            {"role": "user", "content": f"Character: {character}\n\nConversation:\n{convo_text}"}
+        ],
+    }, None
+
+def _end_failed(ctx, e):
+    run_write(lambda s: save_msg(s, ctx["tid"], "system-ui", f"Summary failed: {str(e)}", commit=False),
+              wait=False)
+
+def _end_finish(ctx, payload, usage):
+    """Persist the curator's profile updates + memories. Returns the /api/end response body."""
+    uid, character, tid = ctx["uid"], ctx["character"], ctx["tid"]
     profile_updates = (payload or {}).get("profile_updates") or {}
     memories_items  = (payload or {}).get("memories") or []
 
-    updated = False
-    added = 0
-    with db() as s:
+    # one transaction for the whole curator write-up
+    def tx(s):
+        updated = False
         # count summariser tokens
-        bump_totals(s, tid, usage.prompt_tokens, usage.completion_tokens, usage.total_tokens)
+        bump_totals(s, tid, usage.prompt_tokens, usage.completion_tokens, usage.total_tokens, commit=False)
         save_msg(s, tid, "system-ui", "Session summarised (profile/memories updated).",
-                 uin=usage.prompt_tokens, uout=usage.completion_tokens, utot=usage.total_tokens)
+                 uin=usage.prompt_tokens, uout=usage.completion_tokens, utot=usage.total_tokens,
+                 commit=False, ucached=cached_tokens(usage))
 
         # upsert profile
-        prof = get_or_create_profile(s, uid, character)
+        prof = get_or_create_profile(s, uid, character, commit=False)
         if profile_updates:
             prof.profile_json = merge_profile_json(prof.profile_json, profile_updates)
             prof.last_seen = dt.datetime.utcnow()
-            s.commit()
             updated = True
 
         # add memories
-        added = add_memories(s, uid, character, tid, memories_items)
+        added = add_memories(s, uid, character, tid, memories_items, commit=False)
 
         # mark transcript end time
         tr = s.query(Transcript).get(tid)
         if tr and not tr.ended_at:
             tr.ended_at = dt.datetime.utcnow()
-            s.commit()
+        return updated, added
+
+    updated, added = run_write(tx)
+    count_usage(usage)
+    return {"ok": True, "profile_updated": updated, "memories_added": added}
+
+@app.post("/api/end")
+def end_session():
+    data = request.get_json(force=True)
+    ctx, early = _end_prepare(data)
+    if early:
+        body, status = early
+        return jsonify(body), status
+
+    try:
+        with model_call("curator"):
+            resp = client.chat.completions.create(
+                model="gpt-4o",
+                response_format={"type": "json_object"},
+                messages=ctx["messages"],
+                temperature=0.2
+            )
+        usage = resp.usage
+        payload = json.loads(resp.choices[0].message.content)
+    except Exception as e:
+        _end_failed(ctx, e)
+        return jsonify({"ok": False, "error": str(e)}), 500
 
-    return jsonify({"ok": True, "profile_updated": updated, "memories_added": added})
+    return jsonify(_end_finish(ctx, payload, usage))
 
 # -------------------------------
 # Simple feedback placeholder
@@ -1310,6 +3719,146 @@ def feedback():
     tid = request.args.get("tid", "")
     return f"Thanks for chatting. This is a placeholder feedback endpoint. Transcript: {tid or '(none)'}"
 
+# -------------------------------
+# Static asset pipeline
+#   flask --app app_db build-assets   (run on deploy, after checkout)
+# Copies everything under static/ to static/dist/ with a content hash in the name,
+# adds .gz/.br next to text files and scaled WebP variants of static/images/*.jpg,
+# and writes static/dist/manifest.json: {"images/peter.jpg": "/assets/images/peter.<hash>.jpg", ...}.
+# The manifest is also inlined into dist/index.html, where assetUrl() in the page reads it.
+# Only names listed in the manifest are served from /assets/ with Cache-Control: immutable;
+# the entry page and the manifest itself revalidate, anything else is a 404.
+# -------------------------------
+import gzip, shutil, mimetypes, fnmatch
+
+ASSET_DIR = os.path.join(STATIC_DIR, "dist")
+ASSET_URL_PREFIX = "/assets/"
+ASSET_COMPRESS_EXTS = {".html", ".js", ".css", ".json", ".svg", ".txt"}
+ASSET_WEBP_WIDTHS = [int(w) for w in os.getenv("ASSET_WEBP_WIDTHS", "320,640").split(",") if w.strip()]
+ASSET_WEBP_QUALITY = int(os.getenv("ASSET_WEBP_QUALITY", "80"))
+ASSET_MANIFEST_TAG = '<script id="asset-manifest" type="application/json">{}</script>'
+ASSET_IGNORE = ["dist/*", "index.html", "* - Copy*", "*~", ".*"]   # not published (stray editor copies etc.)
+
+try:
+    import brotli                         # optional: .br variants
+except ImportError:
+    brotli = None
+try:
+    from PIL import Image as PILImage     # optional: WebP variants
+except ImportError:
+    PILImage = None
+
+def _hashed_name(rel, data):
+    root, ext = os.path.splitext(rel)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+
+def _write_asset(rel, data):
+    out = os.path.join(ASSET_DIR, rel)
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "wb") as f:
+        f.write(data)
+    if os.path.splitext(rel)[1].lower() in ASSET_COMPRESS_EXTS:
+        with open(out + ".gz", "wb") as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(out + ".br", "wb") as f:
+                f.write(brotli.compress(data, quality=11))
+
+def _webp_variants(data):
+    """{width: webp bytes} for each ASSET_WEBP_WIDTHS not wider than the source."""
+    with PILImage.open(io.BytesIO(data)) as im:
+        im = im.convert("RGB")
+        out = {}
+        for w in ASSET_WEBP_WIDTHS:
+            if w > im.width:
+                continue
+            buf = io.BytesIO()
+            im.resize((w, round(im.height * w / im.width)), PILImage.LANCZOS).save(
+                buf, "WEBP", quality=ASSET_WEBP_QUALITY, method=6)
+            out[w] = buf.getvalue()
+        return out
+
+def build_assets():
+    """Rebuild static/dist from static/. Returns the manifest."""
+    shutil.rmtree(ASSET_DIR, ignore_errors=True)
+    manifest = {}
+    for path in sorted(glob.glob(os.path.join(STATIC_DIR, "**", "*"), recursive=True)):
+        rel = os.path.relpath(path, STATIC_DIR).replace(os.sep, "/")
+        if not os.path.isfile(path) or any(fnmatch.fnmatch(rel, pat) for pat in ASSET_IGNORE):
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        hashed = _hashed_name(rel, data)
+        _write_asset(hashed, data)
+        manifest[rel] = ASSET_URL_PREFIX + hashed
+        # images/peter.jpg -> images/peter.640w.webp, ...
+        if PILImage is not None and rel.startswith("images/") and rel.lower().endswith((".jpg", ".jpeg")):
+            for w, webp in _webp_variants(data).items():
+                logical = f"{os.path.splitext(rel)[0]}.{w}w.webp"
+                hashed = _hashed_name(logical, webp)
+                _write_asset(hashed, webp)
+                manifest[logical] = ASSET_URL_PREFIX + hashed
+
+    # index.html is the entry point: not renamed (no-cache + ETag), manifest inlined
+    with open(os.path.join(STATIC_DIR, "index.html"), encoding="utf-8") as f:
+        html = f.read()
+    html = html.replace(ASSET_MANIFEST_TAG, ASSET_MANIFEST_TAG.replace(
+        "{}", json.dumps(manifest, sort_keys=True).replace("</", "<\\/")))
+    _write_asset("index.html", html.encode("utf-8"))
+    _write_asset("manifest.json", json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+    return manifest
+
+@app.cli.command("build-assets")
+def build_assets_cmd():
+    """Fingerprint + precompress static/ into static/dist: flask --app app_db build-assets"""
+    manifest = build_assets()
+    missing = [name for name, mod in (("brotli", brotli), ("Pillow", PILImage)) if mod is None]
+    print(f"[ASSETS] {len(manifest)} file(s) -> {ASSET_DIR}"
+          + (f" (not installed, skipped: {', '.join(missing)})" if missing else ""))
+
+_hashed_assets = (None, frozenset())   # (manifest.json mtime, hashed names it lists)
+
+def hashed_asset_names():
+    """Names under static/dist that carry a content hash, per manifest.json (re-read when it changes)."""
+    global _hashed_assets
+    path = os.path.join(ASSET_DIR, "manifest.json")
+    mtime = _mtime(path)
+    if mtime != _hashed_assets[0]:
+        try:
+            with open(path, encoding="utf-8") as f:
+                names = frozenset(url[len(ASSET_URL_PREFIX):] for url in json.load(f).values())
+        except (OSError, ValueError):
+            names = frozenset()
+        _hashed_assets = (mtime, names)
+    return _hashed_assets[1]
+
+def _send_asset(rel, immutable=True):
+    """Serve static/dist/<rel>, picking the .br/.gz twin when the client accepts it."""
+    accept = request.accept_encodings
+    mimetype = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+    for enc, ext in (("br", ".br"), ("gzip", ".gz")):
+        if accept[enc] and os.path.isfile(os.path.join(ASSET_DIR, rel + ext)):
+            # same type and file name as the plain file; only Content-Encoding differs
+            resp = send_from_directory(ASSET_DIR, rel + ext, mimetype=mimetype,
+                                       download_name=os.path.basename(rel))
+            resp.headers["Content-Encoding"] = enc
+            break
+    else:
+        resp = send_from_directory(ASSET_DIR, rel, mimetype=mimetype)
+    if os.path.splitext(rel)[1].lower() in ASSET_COMPRESS_EXTS:
+        resp.vary.add("Accept-Encoding")
+    # hashed names never change content; the entry page must revalidate (ETag)
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable" if immutable else "no-cache"
+    return resp
+
+@app.get("/assets/<path:path>")
+def assets(path):
+    if path in hashed_asset_names():
+        return _send_asset(path)
+    if path in ("index.html", "manifest.json"):
+        return _send_asset(path, immutable=False)
+    abort(404)   # unhashed or leftover files must not be cached for a year
+
 # -------------------------------
 # Static fallback
 # -------------------------------
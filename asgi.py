@@ -0,0 +1,255 @@
+"""
+Async (ASGI) entry point for the same app.
+
+    uvicorn asgi:application --proxy-headers --workers 2
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+
+The chat + voice routes (/api/ask, /api/ask/stream, /api/end, /tts, /stt) run as
+coroutines: model calls go through AsyncOpenAI and SQLite work is pushed to a small
+thread pool, so one process can keep hundreds of model calls in flight.
+Every other route is the unchanged Flask app behind WsgiToAsgi, and the sync
+deployment (gunicorn app_db:app) keeps working as before.
+"""
+import os, json, asyncio, contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import request, jsonify, Response
+from openai import AsyncOpenAI
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+
+import app_db
+from app_db import app
+
+aclient = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# SQLite is sync: keep it off the event loop, but bounded (each thread holds a pooled connection)
+ASYNC_DB_THREADS = int(os.getenv("ASYNC_DB_THREADS", "8"))
+_db_pool = ThreadPoolExecutor(max_workers=ASYNC_DB_THREADS, thread_name_prefix="db")
+
+_wsgi = WsgiToAsgi(app)
+
+
+async def run_db(fn, *args):
+    """Run blocking DB work on the pool. The Flask request context (session etc.) comes along."""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_db_pool, lambda: ctx.run(fn, *args))
+
+
+def _json(body, status=200):
+    resp = jsonify(body)
+    resp.status_code = status
+    return resp, None
+
+
+# -------------------------------
+# Async views (same contracts as the sync ones in app_db)
+# -------------------------------
+async def ask():
+    data = request.get_json(force=True)
+    ctx, early = await run_db(app_db._ask_prepare, data)
+    if early:
+        return _json(*early)
+
+    try:
+        with app_db.model_call("llm"):
+            response = await aclient.chat.completions.create(
+                model="gpt-4o",
+                messages=ctx["messages"],
+                temperature=0.8
+            )
+        message = response.choices[0].message.content.strip()
+        usage = response.usage
+    except Exception as e:
+        await run_db(app_db._ask_failed, ctx, e)
+        return _json({"error": str(e)}, 500)
+
+    meta = await run_db(app_db._ask_finish, ctx, message, usage)
+    return _json({"reply": message, **meta})
+
+
+async def ask_stream():
+    data = request.get_json(force=True)
+    ctx, early = await run_db(app_db._ask_prepare, data)
+    if early:
+        return _json(*early)
+
+    async def gen():
+        parts = []
+        usage = stream = None
+        try:
+            with app_db.model_call("llm"):
+                stream = await aclient.chat.completions.create(
+                    model="gpt-4o",
+                    messages=ctx["messages"],
+                    temperature=0.8,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+                async for chunk in stream:
+                    if chunk.usage:
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        yield app_db._sse("delta", {"text": delta})
+            if usage is None:
+                raise RuntimeError("stream ended without usage")
+        except (GeneratorExit, asyncio.CancelledError):
+            # client disconnected (see _send): same as the sync view, the partial turn is charged
+            if stream is not None:
+                await stream.close()
+            await run_db(app_db._ask_abandoned, ctx, "".join(parts), usage)
+            raise
+        except Exception as e:
+            await run_db(app_db._ask_failed, ctx, e)
+            yield app_db._sse("error", {"error": str(e)})
+            return
+
+        message = "".join(parts).strip()
+        meta = await run_db(app_db._ask_finish, ctx, message, usage)
+        yield app_db._sse("done", {"reply": message, **meta})
+
+    resp = Response(mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp, gen()
+
+
+async def end():
+    data = request.get_json(force=True)
+    ctx, early = await run_db(app_db._end_prepare, data)
+    if early:
+        return _json(*early)
+
+    try:
+        with app_db.model_call("curator"):
+            resp = await aclient.chat.completions.create(
+                model="gpt-4o",
+                response_format={"type": "json_object"},
+                messages=ctx["messages"],
+                temperature=0.2
+            )
+        usage = resp.usage
+        payload = json.loads(resp.choices[0].message.content)
+    except Exception as e:
+        await run_db(app_db._end_failed, ctx, e)
+        return _json({"ok": False, "error": str(e)}, 500)
+
+    return _json(await run_db(app_db._end_finish, ctx, payload, usage))
+
+
+async def stt():
+    files = await run_db(lambda: request.files)   # multipart parsing is CPU/IO work
+    if "file" not in files:
+        return _json({"error": "No file uploaded."}, 400)
+    f = files["file"]
+    with app_db.model_call("stt"):
+        transcript = await aclient.audio.transcriptions.create(
+            model="whisper-1", file=(f.filename or "input.webm", f.read()), response_format="text"
+        )
+    return _json({"transcript": transcript.strip()})
+
+
+async def tts():
+    data = request.json
+    text = data.get("text", "")
+    voice = data.get("voice", "shimmer")
+    if not text:
+        return _json({"error": "No text provided."}, 400)
+    with app_db.model_call("tts"):
+        response = await aclient.audio.speech.create(model="tts-1", voice=voice, input=text)
+    return Response(response.content, mimetype="audio/mpeg"), None
+
+
+ROUTES = {
+    ("POST", "/api/ask"): ask,
+    ("POST", "/api/ask/stream"): ask_stream,
+    ("POST", "/api/end"): end,
+}
+# With stubs on, let the Flask stub views answer instead
+if os.getenv("ENABLE_TTS_STUBS", "").lower() not in ("1","true","yes"):
+    ROUTES[("POST", "/stt")] = stt
+    ROUTES[("POST", "/tts")] = tts
+
+
+# -------------------------------
+# ASGI plumbing
+# -------------------------------
+async def _read_body(receive):
+    chunks = []
+    while True:
+        msg = await receive()
+        chunks.append(msg.get("body", b""))
+        if not msg.get("more_body"):
+            return b"".join(chunks)
+
+
+def _environ(scope, body):
+    headers = [(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]]
+    host = next((v for k, v in headers if k.lower() == "host"), "localhost")
+    environ = EnvironBuilder(
+        path=scope["path"],
+        base_url=f'{scope.get("scheme", "http")}://{host}{scope.get("root_path", "")}',
+        query_string=scope.get("query_string", b"").decode("latin-1"),
+        method=scope["method"],
+        headers=headers,
+        data=body,
+    ).get_environ()
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    return environ
+
+
+async def _send(send, resp, stream):
+    headers = [(k.lower().encode("latin-1"), v.encode("latin-1"))
+               for k, v in resp.headers.items()
+               if not (stream is not None and k.lower() == "content-length")]
+    await send({"type": "http.response.start", "status": resp.status_code, "headers": headers})
+    if stream is None:
+        await send({"type": "http.response.body", "body": resp.get_data()})
+        return
+    try:
+        async for chunk in stream:
+            await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        await stream.aclose()   # a failed send (client gone) still runs the generator's cleanup
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            msg = await receive()
+            if msg["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif msg["type"] == "lifespan.shutdown":
+                await aclient.close()
+                _db_pool.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    view = ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if view is None:
+        return await _wsgi(scope, receive, send)
+
+    body = await _read_body(receive)
+    with app.request_context(_environ(scope, body)):
+        try:
+            # before_request hooks (magic-link uid, session expiry) touch the DB
+            rv = await run_db(app.preprocess_request)
+            if rv is not None:
+                resp, stream = app.make_response(rv), None
+            else:
+                resp, stream = await view()
+        except HTTPException as e:
+            resp, stream = app.make_response(e), None
+        except Exception:
+            app.logger.exception("[ASGI] %s %s failed", scope["method"], scope["path"])
+            resp, stream = _json({"error": "Internal Server Error"}, 500)
+        resp = app.process_response(resp)   # after_request + session cookie
+        await _send(send, resp, stream)
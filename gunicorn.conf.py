@@ -0,0 +1,23 @@
+# Loaded automatically by `gunicorn app_db:app` (and the UvicornWorker variant) from this directory.
+import os, sys, glob, subprocess
+
+
+def on_starting(server):
+    # schema setup once per deploy, before any worker imports the app
+    if os.getenv("AUTO_MIGRATE", "true").lower() in ("1", "true", "yes"):
+        subprocess.run([sys.executable, "-m", "flask", "--app", "app_db", "migrate"],
+                       check=True)
+        os.environ["AUTO_MIGRATE"] = "0"   # inherited by the forked workers
+
+    # multi-process /metrics: drop the previous run's sample files
+    d = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if d and os.path.isdir(d):
+        for f in glob.glob(os.path.join(d, "*.db")):
+            os.remove(f)
+
+
+def child_exit(server, worker):
+    # so a dead worker's in-flight gauge stops counting
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
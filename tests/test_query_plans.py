@@ -0,0 +1,38 @@
+"""Hot queries must plan index lookups, never a full table scan (see app_db._HOT_QUERIES)."""
+import os, sys, tempfile
+
+import pytest
+
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("DB_FILE", os.path.join(_tmp, "plans.sqlite3"))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+for var in ("DB_MAINTENANCE_INTERVAL_SECS", "ROLLUP_INTERVAL_SECS", "SNAPSHOT_INTERVAL_SECS"):
+    os.environ.setdefault(var, "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_db  # noqa: E402
+
+
+@pytest.fixture
+def conn():
+    with app_db.engine.connect() as c:
+        yield c
+
+
+def test_hot_queries_use_indexes(conn):
+    report = app_db.explain_hot_queries(conn)
+    assert "transcript for user+character+month" in report
+    scans = {name: plan for name, (plan, bad) in report.items() if bad}
+    assert not scans, scans
+
+
+def test_dropped_index_is_reported_as_scan(conn):
+    conn.exec_driver_sql("DROP INDEX ix_transcripts_owner_month")
+    try:
+        plan, scans = app_db.explain_hot_queries(conn, names={"transcript for user+character+month"})[
+            "transcript for user+character+month"]
+        assert scans == ["transcripts"], plan
+    finally:
+        conn.exec_driver_sql("""CREATE INDEX ix_transcripts_owner_month
+                                ON transcripts (user_id, character, month_key, started_at)""")
+        conn.commit()